@@ -1,74 +1,27 @@
-import awkward as ak
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 import json
 import os
 import pika
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
-
-######## This loop was needed for this code to work ########
-########        Waits for rabbitmq to be ready      ########
-while True:
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters('rabbitmq')
-        )
-        break
-    except Exception as e:
-        print("RabbitMQ not ready, retrying in 2s...", e)
-        time.sleep(2)
-
-######## Declaring rabbitmq queues ########
-channel = connection.channel()
-channel.queue_declare(queue='aggregate v3', durable=True)
-
-######## Declaring gl*bal variables (don't curse me whoever is reading this plz) ########
-expected = None
-processed = 0
-samples = {}
-
-def block_plotting(channel, method, properties, body):
-    '''
-    Arguments:
-        channel (pika.BlockingConnection.channel) = a rabbitmq object
-        method = needed
-        properties = utilised in template. will keep for safety
-        body = Recieved message
-    Description:
-        This function prevents the plotting code from running till all the files are processed
-    '''
-    global expected, processed, samples # Yeah global variables are bad practice but these three variables are only needed here
-    msg = json.loads(body)
-
-    # check for total file count to wait for
-    if msg.get('file_count'):
-        expected = int(msg['file_count'])
-        print(f"Aggregator: updated expected file count to {expected}")
-        
-    # extract dataset metadata
-    if msg.get('metadata'):
-        samples = msg['metadata']
-        print(f"Aggregator: received sample metadata: {samples}")
-
-    # increment amount of files processed by worker
-    if msg.get("file_done"):
-        processed += 1
-        print(f"Processed {processed}/{expected}")
-
-        # Check if all conditions are satisfied to start plotting
-        if expected is not None and processed == expected:
-            print("All files processed! Proceeding to plotting...")
-            channel.stop_consuming()
-            
-    channel.basic_ack(method.delivery_tag)
-        
-
-channel.basic_consume(queue='aggregate v3', on_message_callback=block_plotting, auto_ack=False) # must not auto ack
-
-print("Waiting for all files to finish processing before plotting...")
-channel.start_consuming()
-connection.close()
+import accumulator
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+######## Live metrics (Prometheus text format) on HZZ_METRICS_PORT, 0 turns them off ########
+METRICS_PORT = int(os.environ.get("HZZ_METRICS_PORT", 8000))
+tasks_expected = Gauge("hzz_aggregator_tasks_expected", "Tasks of the run being aggregated")
+tasks_done = Counter("hzz_aggregator_tasks", "Finished tasks reported by the workers",
+                     ["status"]) # done, cached or quarantined
+results_loaded = Counter("hzz_aggregator_results_loaded", "Worker results merged into the histograms")
+result_bytes = Counter("hzz_aggregator_result_bytes", "Bytes of worker results read")
+load_seconds = Histogram("hzz_aggregator_load_seconds", "Time to read and histogram one worker result",
+                         buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+plot_seconds = Histogram("hzz_aggregator_plot_seconds", "Time to draw the plot",
+                         buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10))
 
 # Variable values ripped from original notebook
 GeV = 1.0
@@ -76,8 +29,8 @@ lumi = 36.6
 fraction = 1.0
 
 # Establish file directories
-data_dir = "/data/"
-figures_dir = "/data/figures"
+data_dir = os.environ.get("HZZ_DATA_DIR", "/data/")
+figures_dir = os.path.join(data_dir, "figures")
 os.makedirs(figures_dir, exist_ok=True)
 
 # x-axis range of the plot
@@ -91,150 +44,503 @@ bin_edges = np.arange(start=xmin, # The interval includes this value
 bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
                         stop=xmax+step_size/2, # The interval doesn't include this value
                         step=step_size ) # Spacing between values
-    
-######## Reading datas from /data/ volume directory ########
-all_samples_from_workers = {}
 
-for frame_file in os.listdir(data_dir):
+# While the workers run, the plot is redrawn from the results merged so far at most every
+# HZZ_SNAPSHOT_INTERVAL seconds (0 only draws the final plot)
+SNAPSHOT_INTERVAL = float(os.environ.get("HZZ_SNAPSHOT_INTERVAL", 60))
+
+# Result files are read on HZZ_LOAD_THREADS threads, only the columns the plot needs
+LOAD_THREADS = int(os.environ.get("HZZ_LOAD_THREADS", 4))
+loader = ThreadPoolExecutor(max_workers=LOAD_THREADS)
+
+def new_histogram():
+    # Empty sum w / sum w^2 accumulator on the plot's binning, the class the workers fill with
+    return accumulator.Histogram(xmin, xmax, step_size)
+
+######## Merging worker results as they arrive ########
+# Workers either write every selected event (*_frames.parquet) or a partial
+# histogram (*_hist.npz). Both end up as per-sample accumulator.Histogram.
+all_hists = {}
+all_cutflows = {}
+loaded = set() # results already merged
+loading = {} # path -> Future of the result being read
+
+def add_cutflow(sample_name, cutflow):
+    # Sum the cut flows of every file of the sample
+    accumulator.merge_cutflows(all_cutflows.setdefault(sample_name, {}), cutflow)
+
+def read_columns(path, columns):
+    '''
+    Arguments:
+        path (str) = parquet file written by a worker
+        columns (list) = names of the columns to read
+    Description:
+        Reads only the given columns, one row group at a time, straight into arrays allocated
+        for the whole file from its metadata, so no other column is ever decoded
+    Returns:
+        dict of np.ndarray, one per column
+    '''
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    buffers = {c: np.empty(parquet_file.metadata.num_rows, dtype=schema.field(c).type.to_pandas_dtype())
+               for c in columns}
+    position = 0
+    for batch in parquet_file.iter_batches(columns=columns):
+        for c in columns:
+            buffers[c][position:position + batch.num_rows] = batch.column(c).to_numpy(zero_copy_only=False)
+        position += batch.num_rows
+    return buffers
+
+def histogram_mapped(path):
+    '''
+    Arguments:
+        path (str) = Arrow IPC file written by a worker
+    Description:
+        Memory maps the file and histograms it one record batch at a time. Uncompressed columns
+        are used in place as NumPy views of the mapped pages, so nothing is decoded or copied and
+        a file read by an earlier run is served straight from the OS page cache. Files without
+        a totalWeight column (real data) are not weighted.
+    Returns:
+        hist (accumulator.Histogram) = sum of weights and sum of squared weights per bin
+    '''
+    hist = new_histogram()
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        weighted = "totalWeight" in reader.schema.names
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            weights = batch.column("totalWeight").to_numpy(zero_copy_only=False) if weighted else None
+            hist.fill(batch.column("mass").to_numpy(zero_copy_only=False), weights)
+    return hist
+
+@load_seconds.time()
+def read_output(path, sample_name, size=None):
+    '''
+    Arguments:
+        path (str) = result file written by a worker
+        sample_name (str) = sample of the result, as listed in the run manifest
+        size (int) = bytes the manifest lists for the file
+    Description:
+        Reads one worker result and histograms it. This is what runs on the loader threads.
+    Returns:
+        (sample_name, accumulator.Histogram, cutflow or None), or None for other files
+    '''
+    frame_file = os.path.basename(path)
+    if size is not None and os.path.getsize(path) != size:
+        raise ValueError(f"{frame_file} is {os.path.getsize(path)} bytes, the manifest lists {size}")
     if frame_file.endswith(".parquet"):
-        path = os.path.join(data_dir, frame_file)
-        print(frame_file)
-        sample_name = frame_file.split("-")[0]
-        print(frame_file, "->", sample_name)
-        frames = ak.from_parquet(path)  # read Awkward Array
-        print(f"Loaded {frame_file}, {len(frames)} events")
-        
-        if sample_name not in all_samples_from_workers:
-            all_samples_from_workers[sample_name] = []
+        # the plot only needs the mass, and the weight of simulated events. The worker leaves the
+        # weight out of data files, so the file's own schema says which columns there are
+        names = pq.read_schema(path).names
+        columns = read_columns(path, [c for c in ["mass", "totalWeight"] if c in names])
+        return (sample_name, new_histogram().fill(columns['mass'], columns.get('totalWeight')), None)
+
+    if frame_file.endswith(".arrow"):
+        return (sample_name, histogram_mapped(path), None)
+
+    if frame_file.endswith("_hist.npz"):
+        with np.load(path) as partial:
+            return (str(partial['sample']),
+                    accumulator.Histogram.from_arrays(partial['bin_edges'], partial['sumw'], partial['sumw2']),
+                    json.loads(str(partial['cutflow'])))
+    return None
+
+def load_output(path, sample_name, size=None):
+    '''
+    Arguments:
+        path (str) = result file written by a worker
+        sample_name (str) = sample of the result
+        size (int) = bytes the manifest lists for the file
+    Description:
+        Starts reading one worker result in the background (once per file), merge_loaded
+        adds it to the running histograms and cut flows
+    '''
+    if path not in loaded and path not in loading:
+        loading[path] = loader.submit(read_output, path, sample_name, size)
 
-        all_samples_from_workers[sample_name].append(frames)
+def merge_loaded(wait=False):
+    '''
+    Arguments:
+        wait (bool) = wait for every result still being read instead of only merging finished ones
+    Description:
+        Merges the results read so far into the running histograms and cut flows
+    Returns:
+        failed (int) = number of results that could not be read
+    '''
+    failed = 0
+    for path, future in list(loading.items()):
+        if not wait and not future.done():
+            continue
+        del loading[path]
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Aggregator: could not read {os.path.basename(path)}: {e}")
+            failed += 1
+            continue
+        if result is None:
+            continue
+        try:
+            merge_result(os.path.basename(path), result)
+        except ValueError as e: # e.g. filled with other binning, must not stop the consumer
+            print(f"Aggregator: could not merge {os.path.basename(path)}: {e}")
+            failed += 1
+            continue
+        loaded.add(path)
+        result_bytes.inc(os.path.getsize(path))
+    return failed
+
+def merge_result(name, result):
+    '''
+    Arguments:
+        name (str) = where the result came from, for the log
+        result (tuple) = (sample_name, accumulator.Histogram, cutflow or None), as from read_output
+    Description:
+        Adds one worker result to the running histograms and cut flows
+    '''
+    sample_name, hist, cutflow = result
+    try:
+        all_hists.setdefault(sample_name, new_histogram()).merge(hist)
+    except ValueError:
+        raise ValueError(f"{name} was filled with different binning to the plot")
+    print(f"Loaded {name} -> {sample_name}")
+    if cutflow is not None:
+        add_cutflow(sample_name, cutflow)
+    results_loaded.inc()
 
-all_data = {}
+######## Declaring gl*bal variables (don't curse me whoever is reading this plz) ########
+expected = None
+processed = 0
+cached = 0 # tasks whose output was already on the volume from an earlier run
+unlocated = 0 # finished tasks whose result could not be merged when their message arrived
+run_id = "default" # run being aggregated, tasks from other runs are ignored
+quarantined = [] # tasks the workers gave up on after their last attempt
+finished = set() # (sample, file, entry_start, entry_stop) of the tasks counted so far
+samples = {}
+last_snapshot = time.time()
+
+def start_run(new_run_id):
+    '''
+    Arguments:
+        new_run_id (str) = run the aggregator switches to
+    Description:
+        Forgets everything about the previous run: counts, histograms, cut flows and its results,
+        including those still being read, so nothing of one run is merged into the plot of another
+    '''
+    global processed, cached, unlocated, run_id, finished
+    for future in loading.values():
+        future.cancel() # one already being read finishes, but is never merged
+    loading.clear()
+    loaded.clear()
+    all_hists.clear()
+    all_cutflows.clear()
+    quarantined.clear()
+    finished = set()
+    processed = cached = unlocated = 0
+    run_id = new_run_id
+
+def task_key(task):
+    # Identifies a task (one file, or a shard of one) in worker reports and quarantined tasks
+    return (task.get("sample"), task.get("file"), task.get("entry_start", 0), task.get("entry_stop"))
+
+def handle_message(msg):
+    '''
+    Arguments:
+        msg (dict) = message from the producer or a worker
+    Description:
+        This function merges each worker result as it arrives and draws intermediate plots every
+        SNAPSHOT_INTERVAL seconds. It does not depend on how the message was delivered, the local
+        backend (run_local.py) hands the worker's messages, in-memory results included, straight to it.
+    Returns:
+        True once all the tasks of the run are processed
+    '''
+    global expected, processed, cached, unlocated, samples, last_snapshot # Yeah global variables are bad practice but these variables are only needed here
+
+    # check for total task count to wait for (one per file, or per shard of a large file)
+    if msg.get('task_count'):
+        expected = int(msg['task_count'])
+        if msg.get('run_id', "default") != run_id:
+            if processed or quarantined or loading:
+                print(f"Aggregator: run {msg.get('run_id', 'default')} started, dropping what run {run_id} left behind")
+            start_run(msg.get('run_id', "default"))
+        tasks_expected.set(expected)
+        print(f"Aggregator: updated expected task count to {expected} for run {run_id}")
+        
+    # extract dataset metadata
+    if msg.get('metadata'):
+        samples = msg['metadata']
+        print(f"Aggregator: received sample metadata: {samples}")
 
-######## "Some required process for the plotting code to work" ########
-######## I'm not too scared to modify the plotting code... nvm ########
-for sample_name, frame_list in all_samples_from_workers.items():
-    print(f"Concatenating {sample_name}: {len(frame_list)} chunks")
-    all_data[sample_name] = ak.concatenate(frame_list)
+    # increment amount of files processed by worker and merge its result
+    done = msg.get("file_done") or msg.get("task_failed")
+    if done and msg.get("run_id", "default") != run_id:
+        print(f"Aggregator: ignoring a task of run {msg.get('run_id', 'default')}")
+        done = False
+    elif done and task_key(msg.get("task", msg)) in finished:
+        # A batch message is redelivered whole when its worker stops partway through it, so a task
+        # can be reported twice. Counting it again would end the run before the others are in.
+        print(f"Aggregator: ignoring a repeated report of {task_key(msg.get('task', msg))}")
+        done = False
+    elif msg.get("file_done"):
+        if msg.get("file") is not None:
+            finished.add(task_key(msg))
+        processed += 1
+        if msg.get("cached"):
+            cached += 1
+        tasks_done.labels("cached" if msg.get("cached") else "done").inc()
+        if msg.get("result") is not None: # handed over in memory by the local backend
+            try:
+                merge_result(os.path.basename(msg["file"]), msg["result"])
+            except ValueError as e:
+                print(f"Aggregator: could not merge {os.path.basename(msg['file'])}: {e}")
+        elif msg.get("output") is None: # picked up from the run manifest once everything is done
+            unlocated += 1
+        else:
+            load_output(os.path.join(data_dir, msg["output"]), msg.get("sample"), msg.get("bytes"))
+        unlocated += merge_loaded() # results that failed are also retried from the run manifest
+        print(f"Processed {processed}/{expected} ({cached} cache hits)")
+    elif msg.get("task_failed"): # quarantined by a worker, counts as done so the run can finish
+        finished.add(task_key(msg["task"]))
+        quarantined.append(msg)
+        tasks_done.labels("quarantined").inc()
+        print(f"Aggregator: task {msg['task']['file']} was quarantined after {msg['attempts']} attempts: {msg['error']}")
+
+    # Check if all conditions are satisfied to start plotting
+    if done and expected is not None and processed + len(quarantined) == expected:
+        print(f"All files processed ({cached} of them reused from earlier runs, "
+              f"{len(quarantined)} quarantined)! Proceeding to plotting...")
+        return True
+    if done and SNAPSHOT_INTERVAL > 0 and samples and time.time() - last_snapshot >= SNAPSHOT_INTERVAL:
+        plot_histograms(f"{processed}/{expected} tasks processed")
+        last_snapshot = time.time()
+    return False
 
-######## Checking if all data is there ########
-print(f"keys from all_data: {all_data.keys()}")
-print(f"all data Data {all_data['Data']}")
+def block_plotting(channel, method, properties, body):
+    '''
+    Arguments:
+        channel (pika.BlockingConnection.channel) = a rabbitmq object
+        method = needed
+        properties = utilised in template. will keep for safety
+        body = Recieved message
+    Description:
+        Hands each message of the aggregate queue to handle_message and stops consuming once
+        all the files are processed
+    '''
+    if handle_message(json.loads(body)):
+        channel.stop_consuming()
+    channel.basic_ack(method.delivery_tag)
 
 '''
-Below is unchanged from the original notebook. 
+Below is unchanged from the original notebook, apart from drawing the
+histograms from the bins summed above instead of from the event arrays,
+and being wrapped in a function so intermediate plots can be drawn.
 Whatever processes or comments from the original are untampered.
 '''
 
-data_x,_ = np.histogram(ak.to_numpy(all_data['Data']['mass']),
-                        bins=bin_edges ) # histogram the data
-data_x_errors = np.sqrt( data_x ) # statistical error on the data
-
-signal_x = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)']['mass']) # histogram the signal
-signal_weights = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)'].totalWeight) # get the weights of the signal events
-signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
-
-mc_x = [] # define list to hold the Monte Carlo histogram entries
-mc_weights = [] # define list to hold the Monte Carlo weights
-mc_colors = [] # define list to hold the colors of the Monte Carlo bars
-mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
-
-for s in samples: # loop over samples
-    if s not in ['Data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
-        mc_x.append( ak.to_numpy(all_data[s]['mass']) ) # append to the list of Monte Carlo histogram entries
-        mc_weights.append( ak.to_numpy(all_data[s].totalWeight) ) # append to the list of Monte Carlo weights
-        mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
-        mc_labels.append( s ) # append to the list of Monte Carlo legend labels
-
-# *************
-# Main plot
-# *************
-fig, main_axes = plt.subplots(figsize=(12, 8))
-
-# plot the data points
-main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
-                    fmt='ko', # 'k' means black and 'o' is for circles
-                    label='Data')
-
-# plot the Monte Carlo bars
-mc_heights = main_axes.hist(mc_x, bins=bin_edges,
-                            weights=mc_weights, stacked=True,
-                            color=mc_colors, label=mc_labels )
-
-mc_x_tot = mc_heights[0][-1] # stacked background MC y-axis value
-
-# calculate MC statistical uncertainty: sqrt(sum w^2)
-mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
-
-# plot the signal bar
-signal_heights = main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot,
-                weights=signal_weights, color=signal_color,
-                label=r'Signal ($m_H$ = 125 GeV)')
-
-# plot the statistical uncertainty
-main_axes.bar(bin_centres, # x
-                2*mc_x_err, # heights
-                alpha=0.5, # half transparency
-                bottom=mc_x_tot-mc_x_err, color='none',
-                hatch="////", width=step_size, label='Stat. Unc.' )
-
-# set the x-limit of the main axes
-main_axes.set_xlim( left=xmin, right=xmax )
-
-# separation of x axis minor ticks
-main_axes.xaxis.set_minor_locator( AutoMinorLocator() )
-
-# set the axis tick parameters for the main axes
-main_axes.tick_params(which='both', # ticks on both x and y axes
-                        direction='in', # Put ticks inside and outside the axes
-                        top=True, # draw ticks on the top axis
-                        right=True ) # draw ticks on right axis
-
-# x-axis label
-main_axes.set_xlabel(r'4-lepton invariant mass $\mathrm{m_{4l}}$ [GeV]',
-                    fontsize=13, x=1, horizontalalignment='right' )
-
-# write y-axis label for main axes
-main_axes.set_ylabel('Events / '+str(step_size)+' GeV',
-                        y=1, horizontalalignment='right')
-
-# set y-axis limits for main axes
-main_axes.set_ylim( bottom=0, top=np.amax(data_x)*2.0 )
-
-# add minor ticks on y-axis for main axes
-main_axes.yaxis.set_minor_locator( AutoMinorLocator() )
-
-# Add text 'ATLAS Open Data' on plot
-plt.text(0.1, # x
-            0.93, # y
-            'ATLAS Open Data', # text
-            transform=main_axes.transAxes, # coordinate system used is that of main_axes
-            fontsize=16 )
-
-# Add text 'for education' on plot
-plt.text(0.1, # x
-            0.88, # y
-            'for education', # text
-            transform=main_axes.transAxes, # coordinate system used is that of main_axes
-            style='italic',
-            fontsize=12 )
-
-# Add energy and luminosity
-lumi_used = str(lumi*fraction) # luminosity to write on the plot
-plt.text(0.1, # x
-            0.82, # y
-            r'$\sqrt{s}$=13 TeV,$\int$L dt = '+lumi_used+' fb$^{-1}$', # text
-            transform=main_axes.transAxes,fontsize=16 ) # coordinate system used is that of main_axes
-
-# Add a label for the analysis carried out
-plt.text(0.1, # x
-            0.76, # y
-            r'$H \rightarrow ZZ^* \rightarrow 4\ell$', # text
-            transform=main_axes.transAxes,fontsize=16 ) # coordinate system used is that of main_axes
-
-# draw the legend
-my_legend = main_axes.legend( frameon=False, fontsize=16 ) # no box around the legend
-
-fig_path = os.path.join(figures_dir, "final_histogram.pdf")
-plt.savefig(fig_path, bbox_inches='tight')
-print(f"Figure saved to {fig_path}") 
\ No newline at end of file
+
+@plot_seconds.time()
+def plot_histograms(progress=None):
+    '''
+    Arguments:
+        progress (str) = note drawn on intermediate plots, None for the final plot
+    Description:
+        Draws the histograms merged so far to final_histogram.pdf/.png in the figures directory
+    '''
+    empty = new_histogram() # samples with no result yet
+
+    data_x = all_hists.get('Data', empty).sumw # histogram the data
+    data_x_errors = np.sqrt( data_x ) # statistical error on the data
+
+    signal_x = all_hists.get(r'Signal ($m_H$ = 125 GeV)', empty).sumw # histogram the signal
+    signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
+
+    mc_x = [] # define list to hold the Monte Carlo bin heights
+    mc_x_sumw2 = [] # define list to hold the Monte Carlo sum of squared weights per bin
+    mc_colors = [] # define list to hold the colors of the Monte Carlo bars
+    mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
+
+    for s in samples: # loop over samples
+        if s not in ['Data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
+            mc_x.append( all_hists.get(s, empty).sumw ) # append to the list of Monte Carlo bin heights
+            mc_x_sumw2.append( all_hists.get(s, empty).sumw2 ) # append to the list of Monte Carlo sum w^2
+            mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
+            mc_labels.append( s ) # append to the list of Monte Carlo legend labels
+
+    # *************
+    # Main plot
+    # *************
+    fig, main_axes = plt.subplots(figsize=(12, 8))
+
+    # plot the data points
+    main_axes.errorbar(x=bin_centres, y=data_x, yerr=data_x_errors,
+                        fmt='ko', # 'k' means black and 'o' is for circles
+                        label='Data')
+
+    # plot the Monte Carlo bars, stacked straight from the merged bin heights
+    mc_x_tot = np.zeros(len(bin_centres)) # stacked background MC y-axis value
+    for x, color, label in zip(mc_x, mc_colors, mc_labels):
+        main_axes.bar(bin_centres, x, bottom=mc_x_tot, width=step_size,
+                      color=color, label=label )
+        mc_x_tot = mc_x_tot + x
+
+    # calculate MC statistical uncertainty: sqrt(sum w^2)
+    mc_x_err = np.sqrt(np.sum(mc_x_sumw2, axis=0))
+
+    # plot the signal bar
+    main_axes.bar(bin_centres, signal_x, bottom=mc_x_tot, width=step_size,
+                    color=signal_color, label=r'Signal ($m_H$ = 125 GeV)')
+
+    # plot the statistical uncertainty
+    main_axes.bar(bin_centres, # x
+                    2*mc_x_err, # heights
+                    alpha=0.5, # half transparency
+                    bottom=mc_x_tot-mc_x_err, color='none',
+                    hatch="////", width=step_size, label='Stat. Unc.' )
+
+    # set the x-limit of the main axes
+    main_axes.set_xlim( left=xmin, right=xmax )
+
+    # separation of x axis minor ticks
+    main_axes.xaxis.set_minor_locator( AutoMinorLocator() )
+
+    # set the axis tick parameters for the main axes
+    main_axes.tick_params(which='both', # ticks on both x and y axes
+                            direction='in', # Put ticks inside and outside the axes
+                            top=True, # draw ticks on the top axis
+                            right=True ) # draw ticks on right axis
+
+    # x-axis label
+    main_axes.set_xlabel(r'4-lepton invariant mass $\mathrm{m_{4l}}$ [GeV]',
+                        fontsize=13, x=1, horizontalalignment='right' )
+
+    # write y-axis label for main axes
+    main_axes.set_ylabel('Events / '+str(step_size)+' GeV',
+                            y=1, horizontalalignment='right')
+
+    # set y-axis limits for main axes
+    if np.amax(data_x) > 0: # no data yet early in a run
+        main_axes.set_ylim( bottom=0, top=np.amax(data_x)*2.0 )
+
+    # add minor ticks on y-axis for main axes
+    main_axes.yaxis.set_minor_locator( AutoMinorLocator() )
+
+    # Add text 'ATLAS Open Data' on plot
+    plt.text(0.1, # x
+                0.93, # y
+                'ATLAS Open Data', # text
+                transform=main_axes.transAxes, # coordinate system used is that of main_axes
+                fontsize=16 )
+
+    # Add text 'for education' on plot
+    plt.text(0.1, # x
+                0.88, # y
+                'for education', # text
+                transform=main_axes.transAxes, # coordinate system used is that of main_axes
+                style='italic',
+                fontsize=12 )
+
+    # Add energy and luminosity
+    lumi_used = str(lumi*fraction) # luminosity to write on the plot
+    plt.text(0.1, # x
+                0.82, # y
+                r'$\sqrt{s}$=13 TeV,$\int$L dt = '+lumi_used+' fb$^{-1}$', # text
+                transform=main_axes.transAxes,fontsize=16 ) # coordinate system used is that of main_axes
+
+    # Add a label for the analysis carried out
+    plt.text(0.1, # x
+                0.76, # y
+                r'$H \rightarrow ZZ^* \rightarrow 4\ell$', # text
+                transform=main_axes.transAxes,fontsize=16 ) # coordinate system used is that of main_axes
+
+    # draw the legend
+    my_legend = main_axes.legend( frameon=False, fontsize=16 ) # no box around the legend
+
+    if progress is not None: # intermediate plot
+        main_axes.set_title(progress, loc='right')
+
+    # Written under a temporary name first, so whoever is watching the plot never opens half a file
+    for extension in ["pdf", "png"]:
+        fig_path = os.path.join(figures_dir, f"final_histogram.{extension}")
+        plt.savefig(fig_path + ".part", bbox_inches='tight', format=extension)
+        os.replace(fig_path + ".part", fig_path)
+        print(f"Figure saved to {fig_path}")
+    plt.close(fig)
+
+
+def consume_rabbitmq():
+    '''
+    Description:
+        Consumes the aggregate queue until every task of the run is processed
+    '''
+    ######## This loop was needed for this code to work ########
+    ########        Waits for rabbitmq to be ready      ########
+    while True:
+        try:
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters('rabbitmq')
+            )
+            break
+        except Exception as e:
+            print("RabbitMQ not ready, retrying in 2s...", e)
+            time.sleep(2)
+
+    ######## Declaring rabbitmq queues ########
+    channel = connection.channel()
+    channel.queue_declare(queue='aggregate v3', durable=True)
+    channel.basic_consume(queue='aggregate v3', on_message_callback=block_plotting, auto_ack=False) # must not auto ack
+
+    print("Waiting for all files to finish processing before plotting...")
+    channel.start_consuming()
+    connection.close()
+
+
+def finish_run():
+    '''
+    Description:
+        Merges whatever is still outstanding once every task is processed, reports the
+        quarantined tasks and draws the final plot
+    '''
+    global unlocated
+    unlocated += merge_loaded(wait=True)
+
+    ######## Picking up results that could not be merged on arrival ########
+    # Only the outputs listed in this run's manifest are used, the volume is never scanned
+    if unlocated:
+        with open(os.path.join(data_dir, "runs", run_id, "manifest.jsonl")) as f:
+            for line in f:
+                entry = json.loads(line)
+                load_output(os.path.join(data_dir, entry["output"]), entry["sample"], entry["bytes"])
+        missing = merge_loaded(wait=True)
+        if missing:
+            print(f"Aggregator: WARNING {missing} results of run {run_id} could not be read")
+
+    ######## Reporting the tasks that were given up on ########
+    if quarantined:
+        report_path = os.path.join(data_dir, "runs", run_id, "quarantine.json")
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump([{"task": q["task"], "attempts": q["attempts"], "error": q["error"]} for q in quarantined], f, indent=2)
+        print(f"Aggregator: WARNING {len(quarantined)} of {expected} tasks failed every attempt and are "
+              f"missing from the plot, see {report_path}")
+        for q in quarantined:
+            print(f"  {q['task']['sample']}: {q['task']['file']} ({q['error']})")
+
+    ######## Checking if all data is there ########
+    print(f"keys from all_hists: {all_hists.keys()}")
+    if all_hists.get('Data') is not None:
+        print(f"all data Data {all_hists['Data'].sumw}")
+    else:
+        print("Aggregator: WARNING no Data result was merged, the plot has no data points")
+
+    if all_cutflows:
+        with open(os.path.join(data_dir, "cutflow.json"), "w") as f:
+            json.dump(all_cutflows, f, indent=2)
+
+    plot_histograms()
+
+
+if __name__ == "__main__":
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    consume_rabbitmq()
+    finish_run()
@@ -0,0 +1,86 @@
+import argparse
+import awkward as ak
+import numpy as np
+import uproot
+
+'''
+Writes synthetic ROOT files with the "analysis" tree the worker reads, so the
+analysis can be benchmarked (or tried out) without the open data release.
+Every branch the worker reads is there with the same type as in the
+exactly4lep skim; the kinematics are random but shaped so that a realistic
+fraction of events passes the selection.
+
+    python benchmarks/generate.py mc.root --events 1000000
+    python benchmarks/generate.py data.root --events 200000 --data
+'''
+
+# Entries per basket cluster, about what the open data files use
+CLUSTER_ENTRIES = 10000
+
+
+def generate(path, events, data=False, leptons=4, seed=0):
+    '''
+    Arguments:
+        path (str) = file to write
+        events (int) = number of entries
+        data (bool) = leave out the MC weight branches, like a real data file
+        leptons (int) = leptons per event, 0 draws 4 or 5 per event
+        seed (int) = random seed, the same seed always gives the same file
+    Description:
+        Writes a synthetic exactly4lep-style file, one basket cluster at a time
+    '''
+    rng = np.random.default_rng(seed)
+    counts = np.full(events, leptons) if leptons else rng.integers(4, 6, events)
+    total = int(counts.sum())
+
+    def per_lepton(values):
+        return ak.unflatten(values, counts)
+
+    # Leptons come in same-flavour pairs most of the time, as from Z decays
+    lep_type = np.where(rng.random(total) < 0.5, 11, 13).astype(np.int32)
+    first_of_pair = np.arange(total) // 2 * 2 # an odd last lepton pairs with itself
+    lep_type = np.where(rng.random(total) < 0.8, lep_type[first_of_pair], lep_type).astype(np.int32)
+    lep_charge = np.where(np.arange(total) % 2 == 0, 1, -1).astype(np.int32)
+    lep_charge = np.where(rng.random(total) < 0.9, lep_charge, -lep_charge).astype(np.int32)
+
+    lep_pt = (rng.exponential(25, total) + 5).astype(np.float32) # GeV, as in the 2025 release
+    lep_eta = rng.uniform(-2.5, 2.5, total).astype(np.float32)
+    branches = {
+        "trigE": rng.random(events) < 0.6,
+        "trigM": rng.random(events) < 0.6,
+        "lep_n": counts.astype(np.int32),
+        "lep_isTrigMatched": per_lepton(rng.random(total) < 0.6),
+        "lep_pt": per_lepton(lep_pt),
+        "lep_eta": per_lepton(lep_eta),
+        "lep_phi": per_lepton(rng.uniform(-np.pi, np.pi, total).astype(np.float32)),
+        "lep_e": per_lepton((lep_pt * np.cosh(lep_eta)).astype(np.float32)),
+        "lep_charge": per_lepton(lep_charge),
+        "lep_type": per_lepton(lep_type),
+        "lep_isLooseID": per_lepton(rng.random(total) < 0.95),
+        "lep_isMediumID": per_lepton(rng.random(total) < 0.95),
+        "lep_isLooseIso": per_lepton(rng.random(total) < 0.95),
+    }
+    if not data:
+        for name in ["mcWeight", "ScaleFactor_PILEUP", "ScaleFactor_ELE", "ScaleFactor_MUON",
+                     "ScaleFactor_LepTRIGGER"]:
+            branches[name] = rng.normal(1, 0.05, events).astype(np.float32)
+        for name, value in [("filteff", 1.0), ("kfac", 1.1), ("xsec", 0.05), ("sum_of_weights", 1e5)]:
+            branches[name] = np.full(events, value, np.float32)
+
+    with uproot.recreate(path) as f:
+        tree = f.mktree("analysis", {name: values.type.content if isinstance(values, ak.Array) else values.dtype
+                                     for name, values in branches.items()})
+        for start in range(0, events, CLUSTER_ENTRIES):
+            tree.extend({name: values[start:start + CLUSTER_ENTRIES] for name, values in branches.items()})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic exactly4lep-style ROOT file")
+    parser.add_argument("path", help="file to write")
+    parser.add_argument("--events", type=int, default=100000, help="number of entries (default 100000)")
+    parser.add_argument("--data", action="store_true", help="leave out the MC weight branches")
+    parser.add_argument("--leptons", type=int, default=4, help="leptons per event, 0 draws 4 or 5 (default 4)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    args = parser.parse_args()
+    generate(args.path, args.events, args.data, args.leptons, args.seed)
+    print(f"Wrote {args.events} events to {args.path}")
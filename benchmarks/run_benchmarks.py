@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import awkward as ak
+import numpy as np
+import uproot
+
+for service in ["common", "worker"]:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", service))
+import HZZAnalysis_Funcs as HZZ
+import kinematics
+from generate import generate
+
+'''
+Benchmarks the hot functions of the worker's analysis and the whole of
+process_data on a synthetic exactly4lep-style file (see generate.py). Every
+function is timed on the jagged awkward arrays and on the dense NumPy arrays
+of the fixed multiplicity fast path. For each benchmark the best and mean
+time over the repeats, events/s and the peak memory allocated during one call
+are written as json, and a previous json can be given to fail on regressions.
+
+    python benchmarks/run_benchmarks.py --events 1000000 --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json --threshold 0.2
+'''
+
+
+def measure(function, events, repeats):
+    '''
+    Arguments:
+        function (callable) = benchmarked call, without arguments
+        events (int) = events it processes per call
+        repeats (int) = number of timed calls
+    Description:
+        Times the call after one warm up call (numba compilation, file cache ...), then
+        measures its peak memory in a separate call, as tracing slows everything down
+    Returns:
+        dict of events, best/mean seconds, events per second and peak memory in bytes
+    '''
+    function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {"events": events, "best_s": best, "mean_s": sum(times) / len(times),
+            "events_per_s": events / best if best > 0 else None, "peak_memory_bytes": peak}
+
+
+def function_benchmarks(path, sample):
+    '''
+    Arguments:
+        path (str) = synthetic file
+        sample (str) = sample name to read it as
+    Returns:
+        dict of {name: (function, events)} for every hot function on the jagged and dense inputs
+    '''
+    with uproot.open(path + ":analysis") as tree:
+        jagged = tree.arrays(HZZ.trigger_variables + HZZ.lepton_variables, library="ak")
+        if not HZZ.is_data(sample): # data files have no weight branches
+            weights = tree.arrays(HZZ.weight_variables + ["sum_of_weights"], library="ak")
+            constants = HZZ.read_weight_constants(tree, 0, tree.num_entries)
+    dense = HZZ.to_dense_batch(jagged)
+    if dense is None:
+        raise ValueError(f"{path} does not have exactly {HZZ.LEPTONS_PER_EVENT} leptons per event")
+    events = len(jagged)
+
+    benchmarks = {}
+    for kind, data in [("jagged", jagged), ("dense", dense)]:
+        benchmarks.update({
+            f"cut_trig[{kind}]": lambda data=data: HZZ.cut_trig(data['trigE'], data['trigM']),
+            f"cut_trig_match[{kind}]": lambda data=data: HZZ.cut_trig_match(data['lep_isTrigMatched']),
+            f"ID_iso_cut[{kind}]": lambda data=data: HZZ.ID_iso_cut(
+                data['lep_isLooseID'], data['lep_isMediumID'], data['lep_isLooseIso'],
+                data['lep_isLooseIso'], data['lep_type']),
+            f"cut_lep_type[{kind}]": lambda data=data: HZZ.cut_lep_type(data['lep_type']),
+            f"cut_lep_charge[{kind}]": lambda data=data: HZZ.cut_lep_charge(data['lep_charge']),
+            f"calc_mass[{kind}]": lambda data=data: HZZ.calc_mass(
+                data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_e']),
+        })
+    if not HZZ.is_data(sample):
+        dense_weights = {field: ak.to_numpy(weights[field]) for field in weights.fields}
+        benchmarks["calc_weight[jagged]"] = lambda: HZZ.calc_weight(HZZ.weight_variables, weights)
+        benchmarks["calc_weight[dense]"] = lambda: HZZ.calc_weight(HZZ.weight_variables, dense_weights)
+        benchmarks["calc_weight[folded]"] = lambda: HZZ.calc_weight(HZZ.weight_variables, dense_weights, constants)
+    return {name: (function, events) for name, function in benchmarks.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    '''
+    Arguments:
+        results (dict) = benchmarks of this run
+        baseline (dict) = benchmarks of a previous run
+        threshold (float) = allowed relative slowdown, 0.2 means 20%
+    Returns:
+        list of (name, baseline events/s, events/s) of the benchmarks that got slower than allowed
+    '''
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {}).get("events_per_s")
+        now = result["events_per_s"]
+        if before and now and now < before * (1 - threshold):
+            regressions.append((name, before, now))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the worker's analysis functions")
+    parser.add_argument("--file", help="exactly4lep-style file to use (default: generate one)")
+    parser.add_argument("--events", type=int, default=200000, help="events of the generated file (default 200000)")
+    parser.add_argument("--sample", default="Signal", help="sample name the file is read as (default Signal)")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per benchmark (default 5)")
+    parser.add_argument("--entry-start", type=int, default=0, help="first entry process_data runs on (default 0)")
+    parser.add_argument("--entry-stop", type=int, help="entry process_data stops at, to benchmark a shard (default: the end)")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", help="json of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative events/s drop counted as a regression (default 0.2)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if path is None:
+            path = os.path.join(tmp, "synthetic.root")
+            generate(path, args.events, data=HZZ.is_data(args.sample))
+        with uproot.open(path + ":analysis") as tree:
+            num_entries = tree.num_entries
+
+        benchmarks = function_benchmarks(path, args.sample)
+        entry_stop = num_entries if args.entry_stop is None else min(args.entry_stop, num_entries)
+        benchmarks["process_data"] = (lambda: HZZ.process_data(path, args.sample, {}, entry_start=args.entry_start,
+                                                                entry_stop=entry_stop),
+                                      max(entry_stop - args.entry_start, 0))
+
+        results = {}
+        for name, (function, events) in benchmarks.items():
+            results[name] = measure(function, events, args.repeats)
+            print(f"{name:28s} {results[name]['events_per_s']:14,.0f} events/s "
+                  f"{results[name]['peak_memory_bytes'] / 1024**2:9.1f} MB peak")
+
+    report = {
+        "meta": {
+            "file": args.file, "events": num_entries, "sample": args.sample, "repeats": args.repeats,
+            "entry_start": args.entry_start, "entry_stop": args.entry_stop,
+            "commit": git_commit(), "python": platform.python_version(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "numpy": np.__version__, "awkward": ak.__version__,
+            "uproot": uproot.__version__, "numba": kinematics.numba is not None,
+        },
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["benchmarks"], args.threshold)
+        for name, before, now in regressions:
+            print(f"REGRESSION {name}: {before:,.0f} -> {now:,.0f} events/s")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,124 @@
+import numpy as np
+
+'''
+Mergeable partial results shared by the worker and the aggregator: the
+weighted histogram of the 4-lepton mass and the cut flow. This directory is
+copied next to the service code in the worker and aggregator images, so both
+fill, merge and serialise them the same way.
+'''
+
+# Binning of the plot, 80-250 GeV in 2.5 GeV bins
+GeV = 1.0
+XMIN = 80 * GeV
+XMAX = 250 * GeV
+STEP = 2.5 * GeV
+
+
+class Histogram:
+    def __init__(self, xmin=XMIN, xmax=XMAX, step=STEP):
+        '''
+        Arguments:
+            xmin, xmax (float) = range of the histogram, xmax is included in the last bin
+            step (float) = width of every bin
+        Description:
+            Sum of weights and sum of squared weights per bin of a uniform binning. The bin of
+            each value is worked out with arithmetic instead of a search over the edges, and both
+            sums come from bincount over the same bin indices.
+        '''
+        self.edges = np.arange(start=xmin, stop=xmax+step, step=step)
+        self.sumw = np.zeros(len(self.edges) - 1)
+        self.sumw2 = np.zeros(len(self.edges) - 1)
+
+    @classmethod
+    def from_arrays(cls, bin_edges, sumw, sumw2):
+        '''
+        Arguments:
+            bin_edges, sumw, sumw2 (np.ndarray) = as returned by arrays()
+        Returns:
+            Histogram holding the given sums
+        '''
+        hist = cls.__new__(cls)
+        hist.edges = np.asarray(bin_edges, dtype=np.float64)
+        hist.sumw = np.array(sumw, dtype=np.float64)
+        hist.sumw2 = np.array(sumw2, dtype=np.float64)
+        return hist
+
+    def arrays(self):
+        # What is stored, e.g. with np.savez(path, **hist.arrays())
+        return {"bin_edges": self.edges, "sumw": self.sumw, "sumw2": self.sumw2}
+
+    def bin_index(self, values):
+        '''
+        Arguments:
+            values (np.ndarray) = values to histogram
+        Returns:
+            (index, inside) = bin of every value inside the range, and the mask of those values
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        first, last, nbins = self.edges[0], self.edges[-1], len(self.edges) - 1
+        inside = (values >= first) & (values <= last) # NaN is never inside
+        values = values[inside]
+        index = ((values - first) * (nbins / (last - first))).astype(np.intp)
+        index[index == nbins] = nbins - 1 # the upper edge belongs to the last bin
+        # Rounding can put a value right next to an edge in the neighbouring bin, compare with the
+        # edges themselves so every value lands exactly where np.histogram would put it
+        index -= values < self.edges[index]
+        index += (values >= self.edges[index + 1]) & (index != nbins - 1)
+        return index, inside
+
+    def fill(self, values, weights=None):
+        '''
+        Arguments:
+            values (np.ndarray) = values to histogram, e.g. 4-lepton masses
+            weights (np.ndarray) = per-value weights, None counts every value once (data)
+        Returns:
+            self
+        '''
+        index, inside = self.bin_index(values)
+        nbins = len(self.edges) - 1
+        if weights is None:
+            counts = np.bincount(index, minlength=nbins)
+            self.sumw += counts
+            self.sumw2 += counts
+            return self
+        weights = np.asarray(weights, dtype=np.float64)[inside]
+        self.sumw += np.bincount(index, weights=weights, minlength=nbins)
+        self.sumw2 += np.bincount(index, weights=np.square(weights), minlength=nbins)
+        return self
+
+    def merge(self, other):
+        '''
+        Arguments:
+            other (Histogram) = histogram of another batch, range or file
+        Description:
+            Adds the sums of other, refusing histograms filled with other binning
+        Returns:
+            self
+        '''
+        if len(other.edges) != len(self.edges) or not np.allclose(other.edges, self.edges):
+            raise ValueError("cannot merge histograms with different binning")
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        return self
+
+
+def merge_cutflows(cutflow, other):
+    '''
+    Arguments:
+        cutflow (dict) = cut flow to add to
+        other (dict) = cut flow of another batch/file
+    Description:
+        Sums another cut flow into cutflow, keeping the cut order
+    Returns:
+        cutflow (dict)
+    '''
+    for name, entry in other.items():
+        if name not in cutflow:
+            cutflow[name] = dict(entry)
+            continue
+        cutflow[name]["events"] += entry["events"]
+        if cutflow[name]["weighted"] is None or entry["weighted"] is None:
+            cutflow[name]["weighted"] = None
+        else:
+            cutflow[name]["weighted"] += entry["weighted"]
+    return cutflow
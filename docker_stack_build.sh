@@ -2,6 +2,7 @@
 set -e  # stop on any error
 
 echo "==== Building Docker images ===="
-docker build -t hzz-worker:latest ./worker
+# worker and aggregator images also copy common/, so they are built from the repository root
+docker build -t hzz-worker:latest -f worker/dockerfile .
 docker build -t hzz-producer:latest ./producer
-docker build -t hzz-aggregator:latest ./aggregator
\ No newline at end of file
+docker build -t hzz-aggregator:latest -f aggregator/dockerfile .
\ No newline at end of file
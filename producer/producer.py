@@ -1,9 +1,14 @@
 import json
+import math
+import os
+import numpy as np
 import pika
 import time
-from atlasopenmagic import install_from_environment
-install_from_environment()
-import atlasopenmagic as atom
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import uproot
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+import publisher
 
 
 def get_file_amount(samples) -> int:
@@ -20,31 +25,157 @@ def get_file_amount(samples) -> int:
         total_files += len(samples[s]['list'])
     return total_files
 
+# Files with more entries than this are split into roughly equal entry-range shards
+SHARD_ENTRIES = int(os.environ.get("HZZ_SHARD_ENTRIES", 500000))
+
+def get_num_entries(url):
+    '''
+    Arguments:
+        url (str) = url of a dataset file
+    Description:
+        Reads the number of entries of the analysis tree (only the file's metadata is fetched)
+    Returns:
+        num_entries (int), or None if the file could not be read
+    '''
+    try:
+        return uproot.open(url + ":analysis").num_entries
+    except Exception as e:
+        print(f"PRODUCER: could not read the entry count of {url}, sending it unsharded: {e}")
+        return None
+
+def make_tasks(samples, shard_entries=SHARD_ENTRIES):
+    '''
+    Arguments:
+        samples (atom.build_dataset()) = Presumably a list of samples
+        shard_entries (int) = target number of entries per task
+    Description:
+        Builds the worker tasks. Large files are split into roughly equal entry ranges
+        (entry_start/entry_stop) so that a few huge files can't hold up the whole run.
+    Returns:
+        tasks (list) = task dictionaries to send to the workers
+    '''
+    files = [(s, val) for s in samples for val in samples[s]['list']]
+    with ThreadPoolExecutor(max_workers=16) as pool: # entry counts are a few small requests per file
+        entries = list(pool.map(get_num_entries, [val for _, val in files]))
+
+    tasks = []
+    for (s, val), num_entries in zip(files, entries):
+        if num_entries is None or num_entries <= shard_entries:
+            tasks.append({"sample": s, "file": val})
+            continue
+        n_shards = math.ceil(num_entries / shard_entries)
+        edges = [num_entries * i // n_shards for i in range(n_shards + 1)]
+        for start, stop in zip(edges[:-1], edges[1:]):
+            tasks.append({"sample": s, "file": val, "entry_start": start, "entry_stop": stop})
+    return tasks
+
+# Tasks are published with publisher confirms, up to PUBLISH_WINDOW unconfirmed messages at a time,
+# PUBLISH_BATCH tasks per message (1 sends every task on its own)
+PUBLISH_WINDOW = int(os.environ.get("HZZ_PUBLISH_WINDOW", 1000))
+PUBLISH_BATCH = int(os.environ.get("HZZ_PUBLISH_BATCH", 1))
+
+# The shared volume (HZZ_DATA_DIR, /data in the containers)
+data_dir = os.environ.get("HZZ_DATA_DIR", "/data/")
+
+######## Live metrics (Prometheus text format) on HZZ_METRICS_PORT, 0 turns them off ########
+METRICS_PORT = int(os.environ.get("HZZ_METRICS_PORT", 8000))
+# The producer is done in seconds, so it keeps serving its metrics this long before exiting
+METRICS_LINGER = float(os.environ.get("HZZ_METRICS_LINGER", 30))
+
+files_total = Gauge("hzz_producer_files", "Input files of the run")
+tasks_total = Gauge("hzz_producer_tasks", "Tasks the files were split into")
+tasks_published = Counter("hzz_producer_tasks_published", "Tasks confirmed by the broker")
+messages_published = Counter("hzz_producer_messages_published", "Messages confirmed by the broker")
+messages_republished = Counter("hzz_producer_messages_republished", "Messages nacked by the broker and sent again")
+planning_seconds = Gauge("hzz_producer_planning_seconds", "Time spent reading entry counts and splitting files")
+publish_seconds = Gauge("hzz_producer_publish_seconds", "Time spent publishing the tasks")
+confirm_seconds = Histogram("hzz_producer_confirm_seconds", "Time from publishing a message to its confirm",
+                            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+def new_run_id():
+    '''
+    Returns:
+        run_id (str) = HZZ_RUN_ID, or a new id made of the start time and a random suffix.
+        Every task and output of the run is tagged with it.
+    '''
+    return os.environ.get("HZZ_RUN_ID") or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+######## Datasets used to rediscover the Higgs boson ########
+RELEASE = '2025e-13tev-beta'
+SKIM = "exactly4lep"
+DEFS = {
+    r'Data':{'dids':['data']},
+    r'Background $Z,t\bar{t},t\bar{t}+V,VVV$':{'dids': [410470,410155,410218,
+                                                        410219,412043,364243,
+                                                        364242,364246,364248,
+                                                        700320,700321,700322,
+                                                        700323,700324,700325], 'color': "#6b59d3" }, # purple
+    r'Background $ZZ^{*}$':     {'dids': [700600],'color': "#ff0000" },# red
+    r'Signal ($m_H$ = 125 GeV)':  {'dids': [345060, 346228, 346310, 346311, 346312,
+                                        346340, 346341, 346342],'color': "#00cdff" },# light blue
+}
+
+def build_samples():
+    '''
+    Description:
+        Looks the files of every sample in DEFS up in the ATLAS open data catalogue. Only done here,
+        so the local backend can plan runs over local files without the catalogue.
+    Returns:
+        samples (atom.build_dataset()) = urls of the files of every sample
+    '''
+    from atlasopenmagic import install_from_environment
+    install_from_environment()
+    import atlasopenmagic as atom
+
+    atom.available_releases()
+    atom.set_release(RELEASE)
+    return atom.build_dataset(DEFS, skim=SKIM, protocol='https', cache=True)
+
+def sample_metadata(samples=()):
+    '''
+    Arguments:
+        samples = names of samples outside DEFS that are processed as well
+    Returns:
+        metadata (dict) = plotting colour of every sample, as sent to the aggregator
+    '''
+    meta = {name: {"color": DEFS[name].get("color", "#000000")} for name in DEFS.keys()}
+    for name in samples:
+        meta.setdefault(name, {"color": "#000000"})
+    return meta
+
+def plan_run(samples):
+    '''
+    Arguments:
+        samples (atom.build_dataset()) = Presumably a list of samples
+    Description:
+        Splits the files into tasks and tags every task with a new run id
+    Returns:
+        (run_id, tasks)
+    '''
+    run_id = new_run_id()
+    planning_start = time.time()
+    tasks = make_tasks(samples)
+    planning_seconds.set(time.time() - planning_start)
+    files_total.set(get_file_amount(samples))
+    tasks_total.set(len(tasks))
+    for task in tasks:
+        task["run_id"] = run_id
+    print(f"PRODUCER: run {run_id}: {get_file_amount(samples)} files split into {len(tasks)} tasks")
+    return run_id, tasks
+
 def main():
     '''
     Description:
         Configures the setup needed to rediscover the Higgs boson.
-        This then leads to the total_file count being sent to the aggregator
+        This then leads to the total task count being sent to the aggregator
         and the urls of the datasets being sent to workers for them to process.
     '''
     
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+
     ######## Extracting datasets ########
-    atom.available_releases()
-    atom.set_release('2025e-13tev-beta')
-    
-    skim = "exactly4lep"
-    defs = {
-        r'Data':{'dids':['data']},
-        r'Background $Z,t\bar{t},t\bar{t}+V,VVV$':{'dids': [410470,410155,410218,
-                                                            410219,412043,364243,
-                                                            364242,364246,364248,
-                                                            700320,700321,700322,
-                                                            700323,700324,700325], 'color': "#6b59d3" }, # purple
-        r'Background $ZZ^{*}$':     {'dids': [700600],'color': "#ff0000" },# red
-        r'Signal ($m_H$ = 125 GeV)':  {'dids': [345060, 346228, 346310, 346311, 346312,
-                                            346340, 346341, 346342],'color': "#00cdff" },# light blue
-}
-    samples = atom.build_dataset(defs, skim=skim, protocol='https', cache=True)
+    samples = build_samples()
 
     ######## Declaring rabbitmq queues ########
     connection = pika.BlockingConnection(
@@ -54,9 +185,12 @@ def main():
     channel.queue_declare(queue='tasks v3', durable = True)
     channel.queue_declare(queue='aggregate v3', durable = True)
 
-    ######## sending total file count to aggregator ########
-    done_msg = {"file_count": str(get_file_amount(samples))}
-    print("PRODUCER: Sending total file count:", done_msg["file_count"])
+    ######## Splitting the files into tasks ########
+    run_id, tasks = plan_run(samples)
+
+    ######## sending total task count (and the run it belongs to) to aggregator ########
+    done_msg = {"task_count": str(len(tasks)), "run_id": run_id}
+    print("PRODUCER: Sending total task count:", done_msg["task_count"])
     channel.basic_publish(
         exchange="",
         routing_key='aggregate v3',
@@ -64,7 +198,7 @@ def main():
     )
     
     ######## sending additional metadata to aggregator ########
-    meta = {name: {"color": defs[name].get("color", "#000000")} for name in defs.keys()}
+    meta = sample_metadata()
     print("PRODUCER: Senting sample metadata to aggregator")
     channel.basic_publish(
         exchange='',
@@ -73,27 +207,51 @@ def main():
     )
 
     ######## Sending urls of datasets to worker queue ########
+    # Published with confirms, PUBLISH_WINDOW messages in flight and PUBLISH_BATCH tasks per message
+    for task in tasks:
+        task["queued_at"] = time.time() # lets the workers measure how long tasks wait in the queue
+    messages = publisher.pack_tasks(tasks, PUBLISH_BATCH)
     start_time = time.time()
-    for s in samples:
-        for val in samples[s]['list']:
-            task = {"sample": s, "file": val}
-            channel.basic_publish(
-                exchange='',
-                routing_key='tasks v3',
-                body=json.dumps(task),
-                properties=pika.BasicProperties(
-                         delivery_mode = pika.DeliveryMode.Persistent #Make message persistent
-                )   
-            )
-            print("Queued:", task)
-        
+    stats = publisher.ConfirmPublisher(
+        pika.ConnectionParameters(host='rabbitmq'), 'tasks v3', PUBLISH_WINDOW
+    ).publish([body for body, _ in messages])
     elapsed_time = time.time() - start_time
-    
+    publish_seconds.set(elapsed_time)
+    tasks_published.inc(len(tasks))
+    messages_published.inc(stats["messages"])
+    messages_republished.inc(stats["republished"])
+    for latency in stats["latencies"]:
+        confirm_seconds.observe(latency)
+    print(f"PRODUCER: Queued {len(tasks)} tasks in {stats['messages']} messages "
+          f"in {elapsed_time * 1000:.1f} ms ({stats['republished']} republished)")
+
     ######## Write task send time benchmark to file ########
-    with open("/data/producer_perf.json", "w") as f:
-        json.dump({"task_alloc_time": elapsed_time}, f)
+    latencies = np.array(stats["latencies"]) * 1000
+    perf = {
+        "run_id": run_id,
+        "task_alloc_time": elapsed_time,
+        "tasks": len(tasks),
+        "messages": stats["messages"],
+        "tasks_per_message": PUBLISH_BATCH,
+        "confirm_window": PUBLISH_WINDOW,
+        "republished": stats["republished"],
+        "tasks_per_second": len(tasks) / elapsed_time if elapsed_time > 0 else None,
+        "messages_per_second": stats["messages"] / elapsed_time if elapsed_time > 0 else None,
+        "confirm_latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "max": float(latencies.max()),
+        } if len(latencies) else None,
+    }
+    with open(os.path.join(data_dir, "producer_perf.json"), "w") as f:
+        json.dump(perf, f)
 
     connection.close() # Close rabbitmq connection
 
+    if METRICS_PORT and METRICS_LINGER > 0:
+        print(f"PRODUCER: serving metrics for another {METRICS_LINGER:g}s")
+        time.sleep(METRICS_LINGER)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+import json
+import time
+import collections
+import pika
+
+'''
+Reliable, fast publishing of the worker tasks. The broker confirms every
+message once it has taken responsibility for it (publisher confirms), but
+instead of waiting for each confirm before sending the next message, up to a
+window of messages is kept in flight and confirms are handled as they arrive.
+Several tasks can be packed into one message to cut the per-message overhead
+further; workers unpack them again.
+'''
+
+
+def pack_tasks(tasks, batch_size):
+    '''
+    Arguments:
+        tasks (list) = task dictionaries
+        batch_size (int) = tasks per message
+    Returns:
+        list of (message body, number of tasks in it). A message holds a single task as
+        before, or {"tasks": [...]} when batch_size > 1
+    '''
+    if batch_size <= 1:
+        return [(json.dumps(task), 1) for task in tasks]
+    return [(json.dumps({"tasks": tasks[i:i + batch_size]}), len(tasks[i:i + batch_size]))
+            for i in range(0, len(tasks), batch_size)]
+
+
+class ConfirmPublisher:
+    def __init__(self, parameters, queue, window):
+        '''
+        Arguments:
+            parameters (pika.ConnectionParameters) = broker to connect to
+            queue (str) = durable queue the messages are published to
+            window (int) = maximum number of published but not yet confirmed messages
+        '''
+        self.parameters = parameters
+        self.queue = queue
+        self.window = max(1, window)
+        self.properties = pika.BasicProperties(
+            delivery_mode = pika.DeliveryMode.Persistent #Make message persistent
+        )
+
+    def publish(self, bodies):
+        '''
+        Arguments:
+            bodies (list) = message bodies to publish
+        Description:
+            Publishes all messages with at most `window` of them unconfirmed at any time and
+            returns once the broker has confirmed every one. Messages the broker nacks are
+            published again.
+        Returns:
+            stats (dict) = messages sent, republished, elapsed seconds and confirm latencies (s)
+        '''
+        self.waiting = collections.deque(bodies) # not published yet (or nacked)
+        self.outstanding = collections.OrderedDict() # delivery tag -> (body, publish time)
+        self.next_tag = 1
+        self.latencies = []
+        self.republished = 0
+        self.error = None
+        self.channel = None
+
+        start = time.perf_counter()
+        self.connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_error,
+            on_close_callback=self.on_connection_closed,
+        )
+        self.connection.ioloop.start()
+        if self.error is not None:
+            raise RuntimeError(f"publishing tasks failed: {self.error}")
+        return {
+            "messages": len(bodies),
+            "republished": self.republished,
+            "elapsed": time.perf_counter() - start,
+            "latencies": self.latencies,
+        }
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        self.error = error
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
+        if self.waiting or self.outstanding:
+            self.error = reason
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.queue_declare(queue=self.queue, durable=True, callback=self.on_queue_declared)
+
+    def on_channel_closed(self, channel, reason):
+        if self.waiting or self.outstanding:
+            self.error = reason
+        if not self.connection.is_closing and not self.connection.is_closed:
+            self.connection.close()
+
+    def on_queue_declared(self, frame):
+        self.channel.confirm_delivery(ack_nack_callback=self.on_confirm, callback=self.on_confirm_mode)
+
+    def on_confirm_mode(self, frame):
+        self.send()
+
+    def send(self):
+        # Top the window up, then close once everything is confirmed
+        while self.waiting and len(self.outstanding) < self.window:
+            body = self.waiting.popleft()
+            self.channel.basic_publish(exchange='', routing_key=self.queue, body=body,
+                                       properties=self.properties)
+            self.outstanding[self.next_tag] = (body, time.perf_counter())
+            self.next_tag += 1
+        if not self.waiting and not self.outstanding:
+            self.connection.close()
+
+    def on_confirm(self, frame):
+        # One confirm may cover every outstanding message up to its tag ("multiple")
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self.outstanding if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self.outstanding else []
+
+        now = time.perf_counter()
+        for tag in tags:
+            body, sent = self.outstanding.pop(tag)
+            if isinstance(method, pika.spec.Basic.Nack): # broker could not take it, send it again
+                self.waiting.append(body)
+                self.republished += 1
+            else:
+                self.latencies.append(now - sent)
+        self.send()
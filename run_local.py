@@ -0,0 +1,170 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import types
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+'''
+Single-node backend for runs on one machine, without RabbitMQ or the swarm
+stack. The producer's planning, the worker's selection and the aggregator's
+merging and plotting run unchanged. Tasks run on a process pool and their
+completion, retry or quarantine messages go through the worker's own
+finish/fail into LocalChannel, the local transport standing in for the
+RabbitMQ channel, which hands them to the aggregator. By default each task's
+partial histogram and cut flow come back from the pool in memory and are
+merged directly, so only cutflow.json and the figures are written to
+--data-dir. With --write-outputs every task goes through worker.process_task
+instead and its output and run manifest are written as on the volume
+(HZZ_OUTPUT_MODE applies), so a second run reuses the outputs of the first.
+
+    python run_local.py                                  # the full dataset, as the producer defines it
+    python run_local.py --sample Data=data.root --sample 'Signal ($m_H$ = 125 GeV)'=signal.root
+'''
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_samples(pairs):
+    '''
+    Arguments:
+        pairs (list) = "sample name=path or url" strings, a sample may be given several times.
+            Split on the last "=", sample names like "Signal ($m_H$ = 125 GeV)" have one of their own
+    Returns:
+        samples (dict) = {sample name: {"list": [files]}}, shaped like atom.build_dataset()
+    '''
+    samples = {}
+    for pair in pairs:
+        name, sep, path = pair.rpartition("=")
+        if not sep or not name or not path:
+            raise ValueError(f"--sample takes NAME=PATH, not {pair!r}")
+        samples.setdefault(name, {"list": []})["list"].append(path)
+    return samples
+
+
+class LocalChannel:
+    def __init__(self, aggregator):
+        '''
+        Arguments:
+            aggregator (module) = the aggregator, messages for it are handed to handle_message
+        Description:
+            Takes the place of the pika channel the worker publishes and acks on, only
+            basic_publish and basic_ack are used. Messages for the aggregate queue go straight to
+            the aggregator through deliver, tasks sent to a retry queue wait here until their delay
+            is over, and quarantined tasks are kept in dead.
+        '''
+        self.aggregator = aggregator
+        self.retries = [] # (time the task is due, task body)
+        self.dead = []
+        self.done = False # set once the aggregator has every task of the run
+
+    def deliver(self, msg):
+        # Hands a message to the aggregator, results in memory included, which JSON could not carry
+        self.done = self.aggregator.handle_message(msg) or self.done
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if routing_key == 'aggregate v3':
+            self.deliver(json.loads(body))
+        elif routing_key.startswith('tasks v3 retry'):
+            self.retries.append((json.loads(body).get("queued_at", time.time()), body))
+        elif routing_key == 'tasks v3 dead':
+            self.dead.append(body)
+
+    def basic_ack(self, delivery_tag):
+        pass # nothing is redelivered locally
+
+    def due(self):
+        # Takes the retried tasks whose delay is over
+        now = time.time()
+        ready = [body for at, body in self.retries if at <= now]
+        self.retries = [(at, body) for at, body in self.retries if at > now]
+        return ready
+
+
+def run(samples, processes, write_outputs=False):
+    '''
+    Arguments:
+        samples (dict) = files of every sample, None looks the producer's datasets up
+        processes (int) = size of the pool the tasks run on
+        write_outputs (bool) = write outputs and run manifests as the worker does on the stack,
+            instead of passing partial histograms back in memory
+    Description:
+        Plans the run, processes every task on the pool and aggregates the results as they come in.
+        Failed tasks are retried and quarantined by the worker's own finish/fail, after
+        HZZ_RETRY_DELAY and up to HZZ_MAX_ATTEMPTS times, as on the stack.
+    '''
+    import producer
+    import worker
+    import aggregator
+
+    if samples is None:
+        samples = producer.build_samples()
+    run_id, tasks = producer.plan_run(samples)
+    channel = LocalChannel(aggregator)
+    aggregator.handle_message({"task_count": str(len(tasks)), "run_id": run_id})
+    aggregator.handle_message({"metadata": producer.sample_metadata(samples)})
+
+    start = time.time()
+    # forkserver: the aggregator's loader threads may be running when the pool starts a process
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        running = {} # future -> task body
+        def submit(body):
+            if write_outputs:
+                running[pool.submit(worker.process_task, None, body, None)] = body
+            else:
+                running[pool.submit(worker.process_in_memory, body)] = body
+        for task in tasks:
+            submit(json.dumps(task))
+        while running or channel.retries:
+            timeout = None
+            if channel.retries:
+                timeout = max(0.0, min(at for at, _ in channel.retries) - time.time())
+            finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in finished:
+                body = running.pop(future)
+                method = types.SimpleNamespace(delivery_tag=None)
+                try:
+                    for msg in future.result():
+                        channel.deliver(msg)
+                    worker.finish(channel, method, body, None)
+                except Exception as e:
+                    print(f"Error processing file {body}: {e}")
+                    worker.finish(channel, method, body, None, e)
+            for body in channel.due():
+                submit(body)
+    print(f"Processed {len(tasks)} tasks on {processes} processes in {time.time() - start:.1f}s")
+    if not channel.done:
+        print("WARNING: the run ended before the aggregator had every task")
+    aggregator.finish_run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the whole analysis on this machine, without RabbitMQ")
+    parser.add_argument("--sample", action="append", metavar="NAME=PATH",
+                        help="process this file (path or url) as part of sample NAME, may be repeated "
+                             "(default: the producer's datasets from the ATLAS open data catalogue)")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="processes to run tasks on (default: HZZ_PROCESSES or the CPUs available)")
+    parser.add_argument("--data-dir", default=os.environ.get("HZZ_DATA_DIR", "hzz-data"),
+                        help="where the figures and cutflow.json, and with --write-outputs the outputs "
+                             "and manifests, are written (default: HZZ_DATA_DIR or ./hzz-data)")
+    parser.add_argument("--write-outputs", action="store_true",
+                        help="write every task's output and run manifest as the worker does on the stack "
+                             "(HZZ_OUTPUT_MODE applies, outputs are reused by later runs) instead of "
+                             "passing partial histograms back in memory")
+    args = parser.parse_args()
+
+    for service in ["common", "producer", "worker", "aggregator"]:
+        sys.path.insert(0, os.path.join(ROOT, service))
+    import parallel
+    processes = args.processes or parallel.pool_size()
+
+    # The services read their settings when they are imported. Every task already runs on a
+    # process of its own, so the worker does not split files over a pool of its own as well.
+    os.environ["HZZ_DATA_DIR"] = args.data_dir
+    os.environ["HZZ_PROCESSES"] = "1"
+
+    samples = parse_samples(args.sample) if args.sample else None
+    run(samples, processes, args.write_outputs)
@@ -1,7 +1,10 @@
+import os
 import uproot
 import awkward as ak
-import vector
-import uproot
+import numpy as np
+from kinematics import four_lepton_kinematics
+import file_cache
+import http_source
 
 '''
 This code was ripped from the original notebook and the involved analysis
@@ -9,11 +12,46 @@ is broadly unchanged. For more information, consult the original notebook!
 '''
 
 # =======================================================================
-def calc_weight(weight_variables, events):
+# Weights are computed in float64, HZZ_WEIGHT_DTYPE=float32 halves their memory and output size
+WEIGHT_DTYPE = np.dtype(os.environ.get("HZZ_WEIGHT_DTYPE", "float64"))
+
+def calc_weight(weight_variables, events, constants=None, dtype=None):
+    '''
+    Arguments:
+        weight_variables (list) = branches multiplied (in absolute value) into the weight
+        events (dict or ak.Array) = dense or jagged batch holding the per-event branches
+        constants (dict) = branches that are constant over the file (see read_weight_constants),
+                           folded into one scalar instead of being read from events
+        dtype (np.dtype) = dtype of the weights, WEIGHT_DTYPE by default
+    Description:
+        Multiplies the per-event factors into a single buffer in place, so no temporary array is
+        made per factor, then applies the folded constants as one scalar
+    Returns:
+        np.ndarray of per-event weights
+    '''
     lumi = 36.6
-    total_weight = lumi * 1000 / events["sum_of_weights"]
+    constants = constants or {}
+    dtype = WEIGHT_DTYPE if dtype is None else dtype
+
+    scale = lumi * 1000
+    total_weight = None
     for variable in weight_variables:
-        total_weight = total_weight * abs(events[variable])
+        if variable in constants:
+            scale *= abs(constants[variable])
+        elif total_weight is None:
+            total_weight = np.array(events[variable], dtype=dtype)
+        else:
+            np.multiply(total_weight, np.asarray(events[variable]), out=total_weight)
+    if total_weight is None: # every factor is constant, one weight per event of the batch
+        n_events = len(events) if isinstance(events, ak.Array) else len(next(iter(events.values())))
+        total_weight = np.ones(n_events, dtype=dtype)
+    np.abs(total_weight, out=total_weight) # |a| * |b| = |a * b|
+
+    if "sum_of_weights" in constants:
+        scale /= constants["sum_of_weights"]
+    else:
+        np.divide(total_weight, np.asarray(events["sum_of_weights"]), out=total_weight)
+    np.multiply(total_weight, scale, out=total_weight)
     return total_weight
 
 
@@ -29,17 +67,35 @@ def cut_lep_charge(lep_charge):
     sum_lep_charge = lep_charge[:, 0] + lep_charge[:, 1] + lep_charge[:, 2] + lep_charge[:, 3] != 0
     return sum_lep_charge # True means we should remove this entry (sum of lepton charges is not equal to 0)
 
+# Dense (N, n) array of the first n leptons of each event
+def first_leptons(lep_var, n=4):
+    if isinstance(lep_var, np.ndarray) and lep_var.shape[1] == n: # already dense (fixed multiplicity fast path)
+        return lep_var
+    return ak.to_numpy(ak.fill_none(ak.pad_none(lep_var, n, axis=1, clip=True), 0))
+
 # Calculate invariant mass of the 4-lepton state
-# [:, i] selects the i-th lepton in each event
 def calc_mass(lep_pt, lep_eta, lep_phi, lep_e):
-    p4 = vector.zip({"pt": lep_pt, "eta": lep_eta, "phi": lep_phi, "E": lep_e})
-    invariant_mass = (p4[:, 0] + p4[:, 1] + p4[:, 2] + p4[:, 3]).M # .M calculates the invariant mass
+    pt, eta, phi, e = (first_leptons(x) for x in (lep_pt, lep_eta, lep_phi, lep_e))
+    no_pairing = np.zeros(pt.shape, dtype=np.int32) # pairing is irrelevant for the 4-lepton mass
+    invariant_mass, _, _ = four_lepton_kinematics(pt, eta, phi, e, no_pairing, no_pairing)
     return invariant_mass
 
+# 4-lepton mass plus the on-shell (Z1) and off-shell (Z2) Z candidate masses, in one pass
+def calc_kinematics(data):
+    return four_lepton_kinematics(*(first_leptons(data[field]) for field in
+                                    ['lep_pt', 'lep_eta', 'lep_phi', 'lep_e', 'lep_type', 'lep_charge']))
+
+
+# Sum over the leptons of each event, for both dense (N, 4) and jagged lepton arrays
+def sum_leptons(lep_var):
+    if isinstance(lep_var, np.ndarray):
+        return lep_var.sum(axis=1)
+    return ak.sum(lep_var, axis=1)
+
 
 def cut_trig_match(lep_trigmatch):
     trigmatch = lep_trigmatch
-    cut1 = ak.sum(trigmatch, axis=1) >= 1
+    cut1 = sum_leptons(trigmatch) >= 1
     return cut1
 
 def cut_trig(trigE,trigM):
@@ -48,80 +104,399 @@ def cut_trig(trigE,trigM):
 
 def ID_iso_cut(IDel,IDmu,isoel,isomu,pid):
     thispid = pid
-    return (ak.sum(((thispid == 13) & IDmu & isomu) | ((thispid == 11) & IDel & isoel), axis=1) == 4)
+    return (sum_leptons(((thispid == 13) & IDmu & isomu) | ((thispid == 11) & IDel & isoel)) == 4)
 
-def process_data(fileString, sample):
-    variables = ['lep_pt','lep_eta','lep_phi','lep_e','lep_charge','lep_type','trigE','trigM','lep_isTrigMatched',
-            'lep_isLooseID','lep_isMediumID','lep_isLooseIso','lep_type']
-    weight_variables = ["filteff","kfac","xsec","mcWeight","ScaleFactor_PILEUP", "ScaleFactor_ELE", "ScaleFactor_MUON", "ScaleFactor_LepTRIGGER"]
+# =======================================================================
+# Cut engine
+# Every cut of a batch is evaluated on the same record array and the masks are
+# ANDed together, so the (jagged) record array is only copied once per batch.
+# The cut flow is a plain dict of {cut name: {"events": n, "weighted": sum w}},
+# kept in the order the cuts are applied so it can go straight into json.
+
+def record_cut(cutflow, name, passed, weights=None):
+    '''
+    Arguments:
+        cutflow (dict) = cut flow to add to
+        name (str) = name of the cut
+        passed (np.ndarray) = boolean mask of events surviving up to and including this cut
+        weights (np.ndarray) = per-event weights, None when they are not available (yet)
+    Description:
+        Adds the pass count and weighted yield of one batch to the cut flow
+    '''
+    if name not in cutflow:
+        cutflow[name] = {"events": 0, "weighted": None if weights is None else 0.0}
+    entry = cutflow[name]
+    entry["events"] += int(np.count_nonzero(passed))
+    if entry["weighted"] is not None and weights is not None:
+        entry["weighted"] += float(np.sum(weights, where=passed))
+
+def combine_cuts(cuts, cutflow=None, weights=None):
+    '''
+    Arguments:
+        cuts (list) = (name, mask) pairs in the order they are applied, True means keep the event
+        cutflow (dict) = optional cut flow to record the pass counts in
+        weights (np.ndarray) = optional per-event weights for the weighted yields
+    Description:
+        ANDs the masks of a batch together, recording how many events survive each step
+    Returns:
+        passed (np.ndarray) = combined boolean mask
+    '''
+    passed = None
+    for name, mask in cuts:
+        mask = np.asarray(ak.to_numpy(mask), dtype=bool)
+        passed = mask if passed is None else passed & mask
+        if cutflow is not None:
+            record_cut(cutflow, name, passed, weights)
+    return passed
 
-    frames = []
-    
-    tree = uproot.open(fileString + ":analysis")
-    
-    sample_data = []
+# =======================================================================
+# Fixed multiplicity fast path
+# With the exactly4lep skim every lepton branch holds exactly 4 entries per
+# event. uproot then hands back each jagged branch as a flat buffer plus
+# offsets 0, 4, 8, ..., so the branch can be viewed as a dense (N, 4) NumPy
+# array without copying and all cuts become plain strided NumPy operations.
+# A batch on this path is a dict of {branch: np.ndarray}; anything else keeps
+# the jagged awkward record array.
+LEPTONS_PER_EVENT = 4
+
+def fixed_leptons(lep_var, n=LEPTONS_PER_EVENT):
+    '''
+    Arguments:
+        lep_var (ak.Array) = jagged lepton branch, as read from the tree
+        n (int) = number of leptons every event should have
+    Description:
+        Views a jagged branch as a dense array when every event has exactly n entries
+    Returns:
+        (N, n) np.ndarray sharing memory with lep_var, or None if the multiplicity is not fixed
+    '''
+    layout = ak.to_layout(lep_var)
+    if isinstance(layout, ak.contents.RegularArray) and layout.size == n:
+        return ak.to_numpy(layout)
+    if not (isinstance(layout, ak.contents.ListOffsetArray) and isinstance(layout.content, ak.contents.NumpyArray)):
+        return None
+    offsets = np.asarray(layout.offsets)
+    if not np.all(offsets[1:] - offsets[:-1] == n):
+        return None
+    return np.asarray(layout.content.data)[offsets[0]:offsets[-1]].reshape(-1, n)
+
+def to_dense_batch(arrays, n=LEPTONS_PER_EVENT):
+    '''
+    Arguments:
+        arrays (ak.Array) = record array as read from the tree
+        n (int) = number of leptons every event should have
+    Description:
+        Converts every branch of a batch to NumPy, without copying
+    Returns:
+        dict of {branch: np.ndarray}, or None if any lepton branch does not have exactly n entries per event
+    '''
+    dense = {}
+    for field in arrays.fields:
+        layout = ak.to_layout(arrays[field])
+        if isinstance(layout, ak.contents.NumpyArray):
+            dense[field] = np.asarray(layout.data)
+        else:
+            dense[field] = fixed_leptons(arrays[field], n)
+            if dense[field] is None:
+                return None
+    return dense
+
+def select(data, mask):
+    '''
+    Arguments:
+        data (dict or ak.Array) = dense or jagged batch
+        mask (np.ndarray) = boolean mask of the events to keep
+    Description:
+        Keeps the masked events of a batch on either path
+    Returns:
+        batch of the same kind as data
+    '''
+    if isinstance(data, dict):
+        return {field: values[mask] for field, values in data.items()}
+    return data[mask]
+
+# =======================================================================
+# Read planning
+# Branches are split by how much they cost to stream. The trigger branches are
+# read first for every entry, everything else is only fetched for the basket
+# clusters that still hold an event after the trigger cuts.
+trigger_variables = ['trigE', 'trigM', 'lep_isTrigMatched']
+lepton_variables = ['lep_pt', 'lep_eta', 'lep_phi', 'lep_e', 'lep_charge', 'lep_type',
+                    'lep_isLooseID', 'lep_isMediumID', 'lep_isLooseIso']
+# Weight branches split by whether they can change from event to event. The cross section,
+# filter efficiency, k-factor and sum of weights belong to the DSID, one per file, so they are
+# read from a single entry per task instead of for every event (see read_weight_constants).
+constant_weight_variables = ["filteff", "kfac", "xsec"]
+event_weight_variables = ["mcWeight", "ScaleFactor_PILEUP", "ScaleFactor_ELE", "ScaleFactor_MUON",
+                          "ScaleFactor_LepTRIGGER"]
+weight_variables = constant_weight_variables + event_weight_variables
+weight_constants = constant_weight_variables + ["sum_of_weights"]
+
+def is_data(sample):
+    return 'data' in sample.lower() # real data never needs the MC weight branches
+
+def plan_branches(sample):
+    '''
+    Arguments:
+        sample (str) = name of the sample the file belongs to
+    Description:
+        Works out the minimal set of branches a file of this sample type needs
+    Returns:
+        (cheap, heavy) = branches read for every entry, branches read for surviving clusters only
+    '''
+    heavy = list(lepton_variables)
+    if not is_data(sample):
+        heavy += event_weight_variables # the weight constants are read once, by read_weight_constants
+    return list(trigger_variables), heavy
+
+def read_weight_constants(tree, entry_start, entry_stop):
+    '''
+    Arguments:
+        tree (uproot.TTree) = the analysis tree
+        entry_start, entry_stop (int) = entry range that will be processed
+    Description:
+        Reads the weight constants from the first and the last entry of the range only. If they
+        differ the file is not a single DSID after all and they are read for every event instead.
+    Returns:
+        dict of {branch: value}, or None when they are not constant over the range
+    '''
+    if entry_stop <= entry_start:
+        return None
+    first = tree.arrays(weight_constants, entry_start=entry_start, entry_stop=entry_start + 1, library="np")
+    last = tree.arrays(weight_constants, entry_start=entry_stop - 1, entry_stop=entry_stop, library="np")
+    if any(first[branch][0] != last[branch][0] for branch in weight_constants):
+        return None
+    return {branch: float(first[branch][0]) for branch in weight_constants}
+
+def surviving_ranges(mask, entry_start, clusters):
+    '''
+    Arguments:
+        mask (np.ndarray) = boolean mask of the entries in [entry_start, entry_start + len(mask))
+        entry_start (int) = tree entry the mask starts at
+        clusters (np.ndarray) = entry offsets where all branches start a new basket
+    Description:
+        Finds the basket clusters holding at least one passing entry and merges neighbours,
+        so each range is fetched with a single read and no basket is streamed twice
+    Returns:
+        list of (start, stop) tree entry ranges
+    '''
+    passed = np.flatnonzero(mask) + entry_start
+    if len(passed) == 0:
+        return []
+    which = np.unique(np.searchsorted(clusters, passed, side="right") - 1)
+    starts, stops = clusters[which], clusters[which + 1]
+    new_range = np.r_[True, starts[1:] != stops[:-1]] # cluster does not touch the previous one
+    starts = np.maximum(starts[new_range], entry_start)
+    stops = np.minimum(stops[np.r_[new_range[1:], True]], entry_start + len(mask))
+    return list(zip(starts.tolist(), stops.tolist()))
+
+def read_selected(tree, branches, mask, entry_start, clusters, dense=False):
+    '''
+    Arguments:
+        tree (uproot.TTree) = the analysis tree
+        branches (list) = branches to read
+        mask (np.ndarray) = entries of this batch that passed the cheap cuts
+        entry_start (int) = tree entry the mask starts at
+        clusters (np.ndarray) = entry offsets where all branches start a new basket
+        dense (bool) = return the fixed multiplicity dict of NumPy arrays instead of an ak.Array
+    Description:
+        Reads branches only for the clusters with surviving entries and keeps the surviving ones
+    Returns:
+        batch of len(np.count_nonzero(mask)) events
+    '''
+    pieces = []
+    for start, stop in surviving_ranges(mask, entry_start, clusters):
+        arrays = tree.arrays(branches, entry_start=start, entry_stop=stop, library="ak")
+        if dense:
+            arrays = to_dense_batch(arrays)
+            if arrays is None:
+                raise ValueError(f"lepton branches of entries {start}-{stop} do not have a fixed multiplicity")
+        pieces.append(select(arrays, mask[start - entry_start:stop - entry_start]))
+    if dense:
+        if len(pieces) == 0:
+            return {field: values[:0] for field, values in
+                    to_dense_batch(tree.arrays(branches, entry_start=entry_start, entry_stop=entry_start, library="ak")).items()}
+        return {field: np.concatenate([piece[field] for piece in pieces]) for field in branches}
+    if len(pieces) == 1:
+        return pieces[0]
+    if len(pieces) == 0:
+        return tree.arrays(branches, entry_start=entry_start, entry_stop=entry_start, library="ak")
+    return ak.concatenate(pieces)
+
+def cluster_offsets(tree, branches, entry_start, entry_stop):
+    '''
+    Arguments:
+        tree (uproot.TTree) = the analysis tree
+        branches (list) = branches that will be read
+        entry_start, entry_stop (int) = entry range that will be processed
+    Description:
+        Finds the entries inside the range where every branch starts a new basket
+    Returns:
+        np.ndarray of offsets starting at entry_start and ending at entry_stop
+    '''
+    offsets = np.asarray(tree.common_entry_offsets(filter_name=branches), dtype=np.int64)
+    inside = offsets[(offsets > entry_start) & (offsets < entry_stop)]
+    return np.concatenate([[entry_start], inside, [entry_stop]]).astype(np.int64)
+
+def batch_ranges(clusters, step):
+    '''
+    Arguments:
+        clusters (np.ndarray) = entry offsets where all branches start a new basket
+        step (int) = maximum number of entries per batch
+    Description:
+        Groups basket clusters into batches of at most step entries. A cluster larger than step
+        is split into batches of step entries, so the batch size (and with it the memory budget)
+        is honoured even then, at the cost of reading the cluster's baskets once per batch.
+    Returns:
+        list of (start, stop) tree entry ranges
+    '''
+    clusters = [int(offset) for offset in clusters]
+    edges = [clusters[0]]
+    largest = 0
+    for previous, offset in zip(clusters[:-1], clusters[1:]):
+        if offset - previous > step:
+            largest = max(largest, offset - previous)
+            if previous != edges[-1]:
+                edges.append(previous)
+            edges.extend(range(previous + step, offset, step))
+            edges.append(offset)
+        elif offset - edges[-1] > step:
+            edges.append(previous)
+    if edges[-1] != clusters[-1]:
+        edges.append(clusters[-1])
+    if largest:
+        print(f"[worker] Basket clusters of up to {largest} entries are larger than the batch of {step} "
+              f"entries, splitting them (their baskets are read once per batch)")
+    return list(zip(edges[:-1], edges[1:]))
+
+# Remote inputs are read through the persistent cache when HZZ_CACHE_DIR is set, and
+# streamed through the worker's pooled HTTP session otherwise
+input_cache = file_cache.from_env()
+
+def open_tree(fileString):
+    if input_cache is not None:
+        fileString = input_cache.fetch(fileString)
+    if file_cache.is_remote(fileString):
+        return uproot.open(fileString + ":analysis", handler=http_source.PooledHTTPSource)
+    return uproot.open(fileString + ":analysis")
+
+def iter_batches(fileString, sample, cutflow=None, step_size="100 MB", entry_start=0, entry_stop=None):
+    '''
+    Arguments:
+        fileString (str) = path or url of the ROOT file
+        sample (str) = name of the sample the file belongs to
+        cutflow (dict) = optional dict that is filled with the cut flow of this file
+        step_size (int or str) = entries per batch, or a memory size like "100 MB" as in tree.iterate
+        entry_start, entry_stop (int) = only process this entry range of the file (default: all of it)
+    Description:
+        Runs the selection over a file one batch at a time, so only one batch is held in memory
+    Yields:
+        ak.Array of the selected events of each batch
+    '''
+    if cutflow is None:
+        cutflow = {}
+    cheap, heavy = plan_branches(sample)
+
+    tree = open_tree(fileString)
 
     fraction = 1.0
 
-    # Loop over data in the tree
-    for data in tree.iterate(variables + weight_variables + ["sum_of_weights", "lep_n"],
-                                library="ak",
-                                entry_stop=tree.num_entries*fraction):#, # process up to numevents*fraction
-                            #  step_size = 10000000):
+    if entry_stop is None:
+        entry_stop = int(tree.num_entries*fraction) # process up to numevents*fraction
+    entry_stop = min(entry_stop, tree.num_entries)
+    entry_start = min(entry_start, entry_stop)
 
-        # Number of events in this batch
-        nIn = len(data)
+    # Monte Carlo weight constants are read once and folded into a single scalar
+    constants = None
+    if not is_data(sample):
+        constants = read_weight_constants(tree, entry_start, entry_stop)
+        if constants is None: # not constant over the range, read them with the per-event branches
+            heavy = heavy + weight_constants
+
+    clusters = cluster_offsets(tree, cheap + heavy, entry_start, entry_stop)
+    if isinstance(step_size, str):
+        step_size = tree.num_entries_for(step_size, filter_name=cheap + heavy)
+    step = max(int(step_size), 1)
+
+    # Loop over data in the tree
+    for batch_start, batch_stop in batch_ranges(clusters, step):
 
-        data = data[cut_trig(data.trigE, data.trigM)]
-        data = data[cut_trig_match(data.lep_isTrigMatched)]
+        data = tree.arrays(cheap, entry_start=batch_start, entry_stop=batch_stop, library="ak")
+        dense = to_dense_batch(data)
+        if dense is not None: # exactly4lep: run the whole batch on dense NumPy arrays
+            data = dense
 
-        # Record transverse momenta (see bonus activity for explanation)
+        # Number of events in this batch
+        record_cut(cutflow, "input", np.ones(batch_stop - batch_start, dtype=bool))
+
+        # Trigger cuts only need the cheap branches
+        trig_mask = combine_cuts([("trigger", cut_trig(data['trigE'], data['trigM'])),
+                                  ("trigger match", cut_trig_match(data['lep_isTrigMatched']))],
+                                 cutflow)
+        data = select(data, trig_mask)
+
+        # Fetch the heavy branches for the surviving entries and attach them
+        selected = read_selected(tree, heavy, trig_mask, batch_start, clusters, dense is not None)
+        for field in heavy:
+            data[field] = selected[field]
+
+        # Monte Carlo weights are needed before the cuts for the weighted yields
+        weights = None
+        if not is_data(sample): # Only calculates weights if the data is MC
+            weights = calc_weight(weight_variables, data, constants)
+
+        # All remaining cuts are built on the same events and applied in one go
+        lep_pt = data['lep_pt']
+        passed = combine_cuts([
+            # Cuts on transverse momentum (see bonus activity for explanation)
+            ("leading lep pt", lep_pt[:,0] > 20),
+            ("sub-leading lep pt", lep_pt[:,1] > 15),
+            ("third leading lep pt", lep_pt[:,2] > 10),
+            ("ID iso", ID_iso_cut(data['lep_isLooseID'],
+                                  data['lep_isMediumID'],
+                                  data['lep_isLooseIso'],
+                                  data['lep_isLooseIso'],
+                                  data['lep_type'])),
+            # Lepton cuts
+            ("lep type", ~cut_lep_type(data['lep_type'])),
+            ("lep charge", ~cut_lep_charge(data['lep_charge'])),
+        ], cutflow, weights)
+        data = select(data, passed)
+
+        # Record transverse momenta
         data['leading_lep_pt'] = data['lep_pt'][:,0]
         data['sub_leading_lep_pt'] = data['lep_pt'][:,1]
         data['third_leading_lep_pt'] = data['lep_pt'][:,2]
         data['last_lep_pt'] = data['lep_pt'][:,3]
 
-        # Cuts on transverse momentum
-        data = data[data['leading_lep_pt'] > 20]
-        data = data[data['sub_leading_lep_pt'] > 15]
-        data = data[data['third_leading_lep_pt'] > 10]
-
-        data = data[ID_iso_cut(data.lep_isLooseID,
-                                data.lep_isMediumID,
-                                data.lep_isLooseIso,
-                                data.lep_isLooseIso,
-                                data.lep_type)]
-
-        # Number Cuts
-        #data = data[data['lep_n'] == 4]
-
-        # Lepton cuts
-
-        lep_type = data['lep_type']
-        data = data[~cut_lep_type(lep_type)]
-        lep_charge = data['lep_charge']
-        data = data[~cut_lep_charge(lep_charge)]
-
-        # Invariant Mass
-        data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_e'])
+        # Invariant Mass and Z candidate masses
+        data['mass'], data['mZ1'], data['mZ2'] = calc_kinematics(data)
 
         # Store Monte Carlo weights in the data
-        if 'data' not in sample: # Only calculates weights if the data is MC
-            data['totalWeight'] = calc_weight(weight_variables, data)
-            # data['totalWeight'] = calc_weight(data)
-
-        # Append data to the whole sample data list
-        sample_data.append(data)
-
-        val = fileString # from the original code because I dont wan't to change too much
-
-        if not 'data' in val:
-            nOut = sum(data['totalWeight']) # sum of weights passing cuts in this batch
-        else:
-            nOut = len(data)
-            
-        #print("\t\t nIn: "+str(nIn)+",\t nOut: \t"+str(nOut)+"\t in "+str(round(elapsed,1))+"s") # events before and after
-
+        if weights is not None:
+            data['totalWeight'] = weights[passed]
+
+        if isinstance(data, dict): # column views like lep_pt[:,0] are strided, arrow needs them contiguous
+            data = ak.zip({field: np.ascontiguousarray(values) for field, values in data.items()}, depth_limit=1)
+        yield data
+
+
+def process_data(fileString, sample, cutflow=None, step_size="100 MB", entry_start=0, entry_stop=None):
+    '''
+    Arguments:
+        fileString (str) = path or url of the ROOT file
+        sample (str) = name of the sample the file belongs to
+        cutflow (dict) = optional dict that is filled with the cut flow of this file
+        step_size (int or str) = entries per batch, or a memory size like "100 MB" as in tree.iterate
+        entry_start, entry_stop (int) = only process this entry range (a shard) of the file (default: all of it)
+    Description:
+        Runs the selection over a whole file, or a shard of it, and returns the surviving events in one array
+    Returns:
+        ak.Array of the selected events
+    '''
+    # Gather every batch of the file into one array
+    sample_data = list(iter_batches(fileString, sample, cutflow, step_size, entry_start, entry_stop))
+    if not sample_data: # an empty entry range has no batch at all
+        return ak.Array([])
     return ak.concatenate(sample_data)
 
     
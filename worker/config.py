@@ -0,0 +1,16 @@
+'''
+Helpers for reading the worker's settings from the environment.
+'''
+
+MEMORY_UNITS = {"B": 1, "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4}
+
+def parse_size(size):
+    '''
+    Arguments:
+        size (str) = memory size like "2 GB", "500MB" or "1000000"
+    Returns:
+        size in bytes (int)
+    '''
+    size = size.strip().upper().replace(" ", "")
+    unit = size.lstrip("0123456789.")
+    return int(float(size[:len(size) - len(unit)]) * MEMORY_UNITS[unit or "B"])
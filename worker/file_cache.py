@@ -0,0 +1,152 @@
+import hashlib
+import os
+import threading
+import time
+import requests
+import http_source
+from config import parse_size
+
+'''
+Persistent cache of remote ROOT inputs on the shared volume. The open data
+release is immutable, so a file is keyed by its url plus the size and ETag
+the server reports; a changed file simply gets a new key. Entries are written
+to a private temporary name and renamed into place, so concurrent workers
+never see (or corrupt) each other's partial downloads. Least recently used
+entries are evicted once the cache is over its byte budget.
+'''
+
+CHUNK_SIZE = 8 * 1024**2
+
+
+def is_remote(path):
+    return path.startswith(("http://", "https://"))
+
+
+def remote_info(url):
+    '''
+    Arguments:
+        url (str) = remote file
+    Returns:
+        (size, etag) = size in bytes and ETag ("" when the server sends none)
+    '''
+    begin = time.perf_counter()
+    headers = http_source.session().head(url, allow_redirects=True, timeout=30).headers
+    http_source.record(0, time.perf_counter() - begin)
+    return int(headers["Content-Length"]), headers.get("ETag", "")
+
+
+def download(url, path):
+    '''
+    Arguments:
+        url (str) = remote file
+        path (str) = where the file ends up
+    Description:
+        Downloads to a name private to this thread and renames it into place once complete
+    '''
+    part = f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+    begin = time.perf_counter()
+    nbytes = 0
+    try:
+        with http_source.session().get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            with open(part, "wb") as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+        os.replace(part, path)
+    finally:
+        http_source.record(nbytes, time.perf_counter() - begin)
+        if os.path.exists(part):
+            os.remove(part)
+
+
+class FileCache:
+    def __init__(self, directory, budget):
+        '''
+        Arguments:
+            directory (str) = cache directory, shared by all workers
+            budget (int) = bytes the cached files may use in total
+        '''
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, url, size, etag):
+        key = hashlib.sha256(f"{url}\n{size}\n{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}-{os.path.basename(url)}")
+
+    def fetch(self, url):
+        '''
+        Arguments:
+            url (str) = path or url of an input file
+        Description:
+            Returns the cached copy of a remote file, downloading it first on a miss
+        Returns:
+            local path of the cached copy, or url itself when it is local, cannot be
+            sized or does not fit in the budget
+        '''
+        if not is_remote(url):
+            return url
+        try:
+            size, etag = remote_info(url)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"[cache] Could not size {url}, streaming it instead: {e}")
+            return url
+        if size > self.budget:
+            return url
+
+        path = self.path_for(url, size, etag)
+        if os.path.exists(path):
+            os.utime(path) # mark as recently used
+            return path
+        try:
+            download(url, path)
+        except (requests.RequestException, OSError) as e:
+            print(f"[cache] Download of {url} failed, streaming it instead: {e}")
+            return url
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        '''
+        Arguments:
+            keep (str) = entry that must survive (the one just added)
+        Description:
+            Deletes least recently used entries until the cache fits in its budget. Readers that
+            already opened an evicted file keep reading it, it is only unlinked.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # evicted by another worker meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= self.budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+
+
+def from_env():
+    '''
+    Description:
+        Builds the cache configured by HZZ_CACHE_DIR and HZZ_CACHE_BUDGET (default "50 GB")
+    Returns:
+        FileCache, or None when no cache directory is set
+    '''
+    directory = os.environ.get("HZZ_CACHE_DIR")
+    if not directory:
+        return None
+    return FileCache(directory, parse_size(os.environ.get("HZZ_CACHE_BUDGET", "50 GB")))
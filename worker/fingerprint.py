@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+import accumulator
+import HZZAnalysis_Funcs as HZZ
+import histograms
+import kinematics
+import outputs
+
+'''
+Fingerprints of task outputs, so a re-run can skip the tasks whose output on
+the volume was made from the same input, entry range, configuration and
+analysis code. The fingerprint is stored next to the output in a small
+"<output>.fingerprint" file, written only once the output is complete,
+together with the output's size, checksum and number of events.
+'''
+
+# The selection and weighting live in these modules, any edit to them changes every fingerprint
+CODE_MODULES = [HZZ, kinematics, histograms, accumulator, outputs]
+
+
+def code_hash():
+    '''
+    Returns:
+        sha256 (str) of the source of the analysis modules
+    '''
+    digest = hashlib.sha256()
+    for module in CODE_MODULES:
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+CODE_HASH = code_hash()
+
+
+def task_fingerprint(task, output_mode):
+    '''
+    Arguments:
+        task (dict) = task as sent by the producer
+        output_mode (str) = "hist" or "events"
+    Returns:
+        sha256 (str) of everything the task's output depends on
+    '''
+    config = {
+        "file": task["file"],
+        "sample": task["sample"],
+        "entry_start": task.get("entry_start", 0),
+        "entry_stop": task.get("entry_stop"),
+        "output_mode": output_mode,
+        "branches": HZZ.plan_branches(task["sample"]),
+        "weight_variables": HZZ.weight_variables,
+        "weight_dtype": HZZ.WEIGHT_DTYPE.name,
+        "bin_edges": histograms.bin_edges.tolist() if output_mode == "hist" else None,
+        "output_schema": outputs.SCHEMA if output_mode == "events" else None,
+        "code": CODE_HASH,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def sidecar(out_file):
+    return f"{out_file}.fingerprint"
+
+
+def lookup(out_file, fingerprint):
+    '''
+    Arguments:
+        out_file (str) = output file of a task
+        fingerprint (str) = fingerprint of the task
+    Returns:
+        the output's record (fingerprint, entries, bytes, sha256) when out_file exists and was made
+        by a task with this fingerprint, None otherwise
+    '''
+    try:
+        with open(sidecar(out_file)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if record.get("fingerprint") != fingerprint or not os.path.exists(out_file):
+        return None
+    return record
+
+
+def invalidate(out_file):
+    # Called before the output is rewritten, so a half written output is never taken as current
+    try:
+        os.remove(sidecar(out_file))
+    except FileNotFoundError:
+        pass
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024**2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def mark(out_file, fingerprint, entries):
+    '''
+    Arguments:
+        out_file (str) = complete output file of a task
+        fingerprint (str) = fingerprint of the task
+        entries (int) = number of selected events in the output
+    Description:
+        Records that out_file is complete and was made by a task with this fingerprint
+    Returns:
+        the output's record (fingerprint, entries, bytes, sha256)
+    '''
+    record = {"fingerprint": fingerprint, "entries": entries,
+              "bytes": os.path.getsize(out_file), "sha256": checksum(out_file)}
+    part = f"{sidecar(out_file)}.{os.getpid()}-{threading.get_ident()}.part"
+    with open(part, "w") as f:
+        json.dump(record, f)
+    os.replace(part, sidecar(out_file))
+    return record
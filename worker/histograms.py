@@ -0,0 +1,43 @@
+import json
+import numpy as np
+from accumulator import Histogram
+
+'''
+Partial histograms written by the worker instead of the full event record.
+The binning must be the same as the aggregator's plot, the edges are stored in
+every file so the aggregator can refuse a partial made with other binning.
+Filling, merging and the stored arrays are accumulator.Histogram's, the class
+the aggregator merges with.
+'''
+
+# Same binning as aggregator.py
+bin_edges = Histogram().edges
+
+
+def fill_batches(batches, data=False):
+    '''
+    Arguments:
+        batches (iterable) = selected events of a task, one ak.Array per batch
+        data (bool) = True for real data, which is not weighted
+    Description:
+        Fills the partial histogram batch by batch, without keeping the events
+    Returns:
+        hist (Histogram) = sum of weights and sum of squared weights per bin
+    '''
+    hist = Histogram()
+    for batch in batches:
+        hist.fill(np.asarray(batch['mass']), None if data else np.asarray(batch['totalWeight']))
+    return hist
+
+
+def write_partial(path, sample, hist, cutflow=None):
+    '''
+    Arguments:
+        path (str) = output file, should end in .npz
+        sample (str) = name of the sample the events belong to
+        hist (Histogram) = partial histogram of the task
+        cutflow (dict) = cut flow of the task
+    Description:
+        Writes the mergeable partial histogram and cut flow of one task
+    '''
+    np.savez(path, sample=sample, cutflow=json.dumps(cutflow or {}), **hist.arrays())
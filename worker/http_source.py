@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import uproot
+from uproot.source.coalesce import CoalesceConfig, coalesce_requests
+
+'''
+HTTP access to the open data files for uproot. Every request of a worker
+process goes through one pooled requests.Session, so the TLS handshake is
+paid once per connection instead of once per file, and the byte ranges uproot
+asks for are coalesced into multi-range requests. Bytes fetched, requests
+made and time spent waiting on the network are counted so each task can
+report them.
+'''
+
+# Coalescing limits, see uproot.source.coalesce
+coalesce_config = CoalesceConfig(
+    max_range_gap=int(os.environ.get("HZZ_HTTP_MAX_RANGE_GAP", 32 * 1024)),
+    max_request_ranges=int(os.environ.get("HZZ_HTTP_MAX_REQUEST_RANGES", 64)),
+    max_request_bytes=int(os.environ.get("HZZ_HTTP_MAX_REQUEST_BYTES", 32 * 1024**2)),
+)
+CONNECTIONS = int(os.environ.get("HZZ_HTTP_CONNECTIONS", 8))
+TIMEOUT = 60
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_executor = None
+_stats = {"bytes": 0, "requests": 0, "seconds": 0.0}
+
+
+def session():
+    '''
+    Description:
+        The pooled session of this process (worker processes forked by the pool get their own)
+    Returns:
+        requests.Session
+    '''
+    global _session, _session_pid, _executor
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=CONNECTIONS, pool_maxsize=CONNECTIONS, max_retries=retries)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _executor = ThreadPoolExecutor(max_workers=CONNECTIONS)
+            _session_pid = os.getpid()
+        return _session
+
+
+def executor():
+    '''
+    Returns:
+        thread pool of this process that runs the requests of the pooled session
+    '''
+    session()
+    return _executor
+
+
+def record(nbytes, seconds, count=1):
+    with _lock:
+        _stats["bytes"] += nbytes
+        _stats["requests"] += count
+        _stats["seconds"] += seconds
+
+
+def network_stats():
+    '''
+    Returns:
+        copy of the bytes/requests/seconds counted so far in this process
+    '''
+    with _lock:
+        return dict(_stats)
+
+
+def stats_since(before):
+    '''
+    Arguments:
+        before (dict) = earlier result of network_stats()
+    Returns:
+        bytes/requests/seconds counted since then
+    '''
+    now = network_stats()
+    return {key: now[key] - before[key] for key in now}
+
+
+def _parse_byteranges(body, content_type):
+    # Parts of a multipart/byteranges response as {start: data}. Each part's length is
+    # taken from its Content-Range, so the payload is never searched for the boundary.
+    boundary = b"--" + content_type.split("boundary=")[1].strip('"').encode()
+    parts = {}
+    position = body.find(boundary)
+    while position != -1 and body[position + len(boundary):position + len(boundary) + 2] != b"--":
+        header_end = body.index(b"\r\n\r\n", position)
+        headers = body[position:header_end].decode("latin-1").lower()
+        first, last = headers.split("content-range: bytes ")[1].split("/")[0].split("-")
+        first, last = int(first), int(last)
+        parts[first] = body[header_end + 4:header_end + 4 + last - first + 1]
+        position = body.find(boundary, header_end + 4 + last - first + 1)
+    return parts
+
+
+def fetch_ranges(url, ranges):
+    '''
+    Arguments:
+        url (str) = remote file
+        ranges (list) = (start, stop) byte ranges, stop excluded
+    Description:
+        Fetches all ranges with one multi-range request on the pooled session
+    Returns:
+        list of bytes, one per range
+    '''
+    header = "bytes=" + ",".join(f"{start}-{stop - 1}" for start, stop in ranges)
+    begin = time.perf_counter()
+    response = session().get(url, headers={"Range": header}, timeout=TIMEOUT)
+    response.raise_for_status()
+    body = response.content
+    record(len(body), time.perf_counter() - begin)
+
+    if response.status_code == 200: # server ignored the Range header and sent the whole file
+        parts = {0: body}
+    elif response.headers.get("Content-Type", "").startswith("multipart/byteranges"):
+        parts = _parse_byteranges(body, response.headers["Content-Type"])
+    else: # a single range, possibly the server merging all of ours
+        first = int(response.headers["Content-Range"].split()[1].split("-")[0])
+        parts = {first: body}
+
+    # The server may merge ranges, so look each one up in the part that contains it
+    starts = sorted(parts)
+    out = []
+    for start, stop in ranges:
+        first = max(s for s in starts if s <= start)
+        out.append(parts[first][start - first:stop - first])
+    return out
+
+
+class PooledHTTPSource(uproot.source.chunk.Source):
+    '''
+    uproot Source reading a remote file through the pooled session with coalesced
+    multi-range requests. Passed to uproot.open as handler.
+    '''
+
+    def __init__(self, file_path, **options):
+        super().__init__()
+        self._file_path = file_path
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self._closed = True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def num_bytes(self):
+        if self._num_bytes is None:
+            begin = time.perf_counter()
+            response = session().head(self._file_path, allow_redirects=True, timeout=TIMEOUT)
+            response.raise_for_status()
+            record(0, time.perf_counter() - begin)
+            self._num_bytes = int(response.headers["Content-Length"])
+        return self._num_bytes
+
+    def chunk(self, start, stop):
+        self._num_requests += 1
+        self._num_requested_chunks += 1
+        self._num_requested_bytes += stop - start
+        data = fetch_ranges(self._file_path, [(start, stop)])[0]
+        return uproot.source.chunk.Chunk(self, start, stop, uproot.source.futures.TrivialFuture(data))
+
+    def chunks(self, ranges, notifications):
+        self._num_requests += 1
+        self._num_requested_chunks += len(ranges)
+        self._num_requested_bytes += sum(stop - start for start, stop in ranges)
+
+        def submit(request_ranges):
+            return executor().submit(fetch_ranges, self._file_path, request_ranges)
+
+        return coalesce_requests(ranges, submit, self, notifications, config=coalesce_config)
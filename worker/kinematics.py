@@ -0,0 +1,112 @@
+import numpy as np
+
+'''
+Flat four-lepton kinematics. Everything works on dense (N, 4) arrays of the
+lepton pt/eta/phi/E so the 4-lepton mass and the Z candidate masses come out of
+a single pass over the leptons, without building vector/awkward objects.
+If numba is installed the per-event loop is compiled, otherwise the same
+numbers are computed with whole-array NumPy operations.
+'''
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+Z_MASS = 91.1876 # GeV
+
+# The six lepton pairs of a 4-lepton event, ordered so that the partner of
+# pair i (the pair made of the two other leptons) is pair 5 - i
+PAIRS = np.array([(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)])
+
+
+def _four_lepton_numpy(pt, eta, phi, e, lep_type, lep_charge):
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+
+    # 4-lepton invariant mass
+    m2 = e.sum(axis=1)**2 - px.sum(axis=1)**2 - py.sum(axis=1)**2 - pz.sum(axis=1)**2
+    m4l = np.sqrt(np.maximum(m2, 0))
+
+    # Invariant masses of all six pairs
+    i, j = PAIRS[:, 0], PAIRS[:, 1]
+    pair_m2 = ((e[:, i] + e[:, j])**2 - (px[:, i] + px[:, j])**2
+               - (py[:, i] + py[:, j])**2 - (pz[:, i] + pz[:, j])**2)
+    pair_m = np.sqrt(np.maximum(pair_m2, 0))
+
+    # A pair can only be Z1 if both it and its partner are same-flavour opposite-sign
+    sfos = (lep_type[:, i] == lep_type[:, j]) & (lep_charge[:, i] + lep_charge[:, j] == 0)
+    valid = sfos & sfos[:, ::-1]
+    distance = np.where(valid, np.abs(pair_m - Z_MASS), np.inf)
+
+    z1 = np.argmin(distance, axis=1)
+    rows = np.arange(len(pt))
+    has_pair = valid.any(axis=1)
+    mZ1 = np.where(has_pair, pair_m[rows, z1], np.nan)
+    mZ2 = np.where(has_pair, pair_m[rows, 5 - z1], np.nan)
+    return m4l, mZ1, mZ2
+
+
+def _four_lepton_loop(pt, eta, phi, e, lep_type, lep_charge, m4l, mZ1, mZ2):
+    n = pt.shape[0]
+    px = np.empty(4)
+    py = np.empty(4)
+    pz = np.empty(4)
+    for k in range(n):
+        for l in range(4):
+            px[l] = pt[k, l] * np.cos(phi[k, l])
+            py[l] = pt[k, l] * np.sin(phi[k, l])
+            pz[l] = pt[k, l] * np.sinh(eta[k, l])
+        m2 = ((e[k, 0] + e[k, 1] + e[k, 2] + e[k, 3])**2
+              - (px[0] + px[1] + px[2] + px[3])**2
+              - (py[0] + py[1] + py[2] + py[3])**2
+              - (pz[0] + pz[1] + pz[2] + pz[3])**2)
+        m4l[k] = np.sqrt(max(m2, 0.0))
+
+        best = np.inf
+        mZ1[k] = np.nan
+        mZ2[k] = np.nan
+        for p in range(6):
+            i, j = PAIRS[p, 0], PAIRS[p, 1]
+            a, b = PAIRS[5 - p, 0], PAIRS[5 - p, 1]
+            if lep_type[k, i] != lep_type[k, j] or lep_charge[k, i] + lep_charge[k, j] != 0:
+                continue
+            if lep_type[k, a] != lep_type[k, b] or lep_charge[k, a] + lep_charge[k, b] != 0:
+                continue
+            m2 = ((e[k, i] + e[k, j])**2 - (px[i] + px[j])**2
+                  - (py[i] + py[j])**2 - (pz[i] + pz[j])**2)
+            m = np.sqrt(max(m2, 0.0))
+            if abs(m - Z_MASS) < best:
+                best = abs(m - Z_MASS)
+                m2 = ((e[k, a] + e[k, b])**2 - (px[a] + px[b])**2
+                      - (py[a] + py[b])**2 - (pz[a] + pz[b])**2)
+                mZ1[k] = m
+                mZ2[k] = np.sqrt(max(m2, 0.0))
+
+
+if numba is not None:
+    _four_lepton_loop = numba.njit(cache=True, nogil=True)(_four_lepton_loop)
+
+
+def four_lepton_kinematics(pt, eta, phi, e, lep_type, lep_charge):
+    '''
+    Arguments:
+        pt, eta, phi, e (np.ndarray) = (N, 4) lepton kinematics
+        lep_type (np.ndarray) = (N, 4) lepton type (electron 11, muon 13)
+        lep_charge (np.ndarray) = (N, 4) lepton charge
+    Description:
+        Computes the 4-lepton invariant mass and the Z candidate masses in one pass.
+        Z1 is the same-flavour opposite-sign pair closest to the Z mass whose partner pair
+        is also same-flavour opposite-sign, Z2 is that partner. Events without such a
+        pairing get NaN for both.
+    Returns:
+        (m4l, mZ1, mZ2) = float64 arrays of length N
+    '''
+    pt, eta, phi, e = (np.asarray(x, dtype=np.float64) for x in (pt, eta, phi, e))
+    lep_type, lep_charge = np.asarray(lep_type), np.asarray(lep_charge)
+    if numba is None:
+        return _four_lepton_numpy(pt, eta, phi, e, lep_type, lep_charge)
+    m4l, mZ1, mZ2 = np.empty(len(pt)), np.empty(len(pt)), np.empty(len(pt))
+    _four_lepton_loop(pt, eta, phi, e, lep_type, lep_charge, m4l, mZ1, mZ2)
+    return m4l, mZ1, mZ2
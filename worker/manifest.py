@@ -0,0 +1,59 @@
+import json
+import os
+
+'''
+Per-run manifest of the outputs on the volume. Every task appends one line
+to /data/runs/<run id>/manifest.jsonl once its output is complete, and the
+aggregator loads exactly the outputs listed for its run, so results of other
+runs sharing the volume are never mixed in.
+'''
+
+
+def manifest_path(data_dir, run_id):
+    return os.path.join(data_dir, "runs", run_id, "manifest.jsonl")
+
+
+def append(data_dir, run_id, entry):
+    '''
+    Arguments:
+        data_dir (str) = the shared volume
+        run_id (str) = run the task belongs to
+        entry (dict) = output, sample, entries, bytes, sha256 ... of a finished task
+    Description:
+        Appends the entry as one line with a single write on a file opened for appending,
+        so lines of workers finishing at the same time never interleave
+    '''
+    path = manifest_path(data_dir, run_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = (json.dumps(dict(entry, run_id=run_id)) + "\n").encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def task_key(task):
+    # Identifies a task (one file, or a shard of one) in tasks and manifest entries alike
+    return (task["sample"], task["file"], task.get("entry_start", 0), task.get("entry_stop"))
+
+
+def finished_tasks(data_dir, run_id):
+    '''
+    Arguments:
+        data_dir (str) = the shared volume
+        run_id (str) = run to look up
+    Returns:
+        set of task_key of every task listed in the run's manifest
+    '''
+    finished = set()
+    try:
+        with open(manifest_path(data_dir, run_id)) as f:
+            for line in f:
+                try:
+                    finished.add(task_key(json.loads(line)))
+                except (ValueError, KeyError): # a line cut short by a worker stopping mid write
+                    continue
+    except FileNotFoundError:
+        pass
+    return finished
@@ -0,0 +1,55 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+'''
+Live metrics of the worker in Prometheus text format, served on
+HZZ_METRICS_PORT (default 8000, 0 turns it off). The process metrics of the
+client library (process_resident_memory_bytes, CPU seconds ...) come with it.
+'''
+
+METRICS_PORT = int(os.environ.get("HZZ_METRICS_PORT", 8000))
+
+# A task takes from well under a second (a cache hit) to many minutes (a large file over the network)
+TASK_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+tasks = Counter("hzz_worker_tasks", "Tasks finished by this worker",
+                ["status"]) # done, cached, retried or quarantined
+task_seconds = Histogram("hzz_worker_task_seconds", "Time spent processing a task",
+                         ["sample"], buckets=TASK_BUCKETS)
+queue_wait_seconds = Histogram("hzz_worker_queue_wait_seconds",
+                               "Time from a task being queued to this worker starting it",
+                               buckets=TASK_BUCKETS)
+in_flight = Gauge("hzz_worker_tasks_in_flight", "Tasks being processed right now")
+reserved = Gauge("hzz_worker_tasks_reserved", "Tasks delivered to this worker and waiting to start")
+events_in = Counter("hzz_worker_events_in", "Events read from the input files", ["sample"])
+events_out = Counter("hzz_worker_events_out", "Events passing the selection", ["sample"])
+network_bytes = Counter("hzz_worker_network_bytes", "Bytes fetched over HTTP")
+network_requests = Counter("hzz_worker_network_requests", "HTTP requests made")
+network_seconds = Counter("hzz_worker_network_seconds", "Time spent waiting on HTTP requests")
+output_bytes = Counter("hzz_worker_output_bytes", "Bytes of outputs written to the volume")
+
+
+def start():
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        print(f"[worker] Metrics on port {METRICS_PORT}")
+
+
+def record_task(sample, seconds, cutflow, network, nbytes):
+    '''
+    Arguments:
+        sample (str) = sample of the finished task
+        seconds (float) = time it took
+        cutflow (dict) = its cut flow
+        network (dict) = bytes/requests/seconds it spent on the network
+        nbytes (int) = size of its output
+    '''
+    tasks.labels("done").inc()
+    task_seconds.labels(sample).observe(seconds)
+    if cutflow:
+        events_in.labels(sample).inc(cutflow.get("input", {}).get("events", 0))
+        events_out.labels(sample).inc(list(cutflow.values())[-1]["events"])
+    network_bytes.inc(network["bytes"])
+    network_requests.inc(network["requests"])
+    network_seconds.inc(network["seconds"])
+    output_bytes.inc(nbytes)
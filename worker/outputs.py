@@ -0,0 +1,187 @@
+import os
+import awkward as ak
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''
+Writers for the per-task event output. Batches are written as they come out
+of HZZAnalysis_Funcs.iter_batches, so a worker never holds more than one
+batch of selected events whatever the size of the input file. Events go to
+parquet, or to an Arrow IPC (Feather) file that the aggregator memory maps
+and histograms in place, without decoding or copying it.
+'''
+
+# Columns every event output has, the only ones the aggregator reads
+BASE_COLUMNS = ["mass", "totalWeight"]
+
+
+def output_schema():
+    '''
+    Description:
+        Reads the event output settings from the environment. HZZ_OUTPUT_COLUMNS lists extra
+        columns to write besides BASE_COLUMNS ("all" writes every field of the selected events),
+        HZZ_OUTPUT_DTYPE=float32 downcasts float64 columns. HZZ_OUTPUT_FORMAT is "parquet"
+        (default) or "arrow", HZZ_OUTPUT_COMPRESSION and HZZ_OUTPUT_COMPRESSION_LEVEL pick the
+        codec and its level: zstd by default for parquet, none by default for arrow, whose
+        uncompressed files are mapped without decoding (lz4 and zstd are allowed too).
+    Returns:
+        schema (dict) = columns (list, None for every field), float32 (bool), format (str),
+        compression (str), compression_level (int or None)
+    '''
+    extra = [c.strip() for c in os.environ.get("HZZ_OUTPUT_COLUMNS", "").split(",") if c.strip()]
+    level = os.environ.get("HZZ_OUTPUT_COMPRESSION_LEVEL", "").strip()
+    output_format = os.environ.get("HZZ_OUTPUT_FORMAT", "parquet")
+    if output_format not in ("parquet", "arrow"):
+        raise ValueError(f"HZZ_OUTPUT_FORMAT must be parquet or arrow, not {output_format!r}")
+    compression = os.environ.get("HZZ_OUTPUT_COMPRESSION", "zstd" if output_format == "parquet" else "none")
+    if output_format == "arrow" and compression not in ("none", "lz4", "zstd"):
+        raise ValueError(f"arrow outputs can be compressed with lz4 or zstd, not {compression!r}")
+    return {
+        "columns": None if extra == ["all"] else BASE_COLUMNS + [c for c in extra if c not in BASE_COLUMNS],
+        "float32": os.environ.get("HZZ_OUTPUT_DTYPE", "float64") == "float32",
+        "format": output_format,
+        "compression": compression,
+        "compression_level": int(level) if level else None,
+    }
+
+SCHEMA = output_schema()
+EXTENSION = f".{SCHEMA['format']}"
+
+
+def to_table(batch, schema=SCHEMA):
+    '''
+    Arguments:
+        batch (ak.Array) = selected events of one batch
+        schema (dict) = output settings, see output_schema
+    Description:
+        Keeps the columns of the schema the batch has (data has no totalWeight) and downcasts
+    Returns:
+        pyarrow table of the batch
+    '''
+    if schema["columns"] is not None:
+        batch = batch[[c for c in schema["columns"] if c in batch.fields]]
+    table = ak.to_arrow_table(batch, extensionarray=False)
+    if schema["float32"]:
+        table = table.cast(pa.schema([field.with_type(pa.float32()) if pa.types.is_float64(field.type) else field
+                                      for field in table.schema]))
+    return table
+
+
+def empty_table(data, schema=SCHEMA):
+    '''
+    Arguments:
+        data (bool) = True for real data, which has no totalWeight
+        schema (dict) = output settings, for the dtype
+    Returns:
+        pyarrow table of the columns the aggregator reads, without any row
+    '''
+    dtype = pa.float32() if schema["float32"] else pa.float64()
+    return pa.table({c: pa.array([], type=dtype) for c in (["mass"] if data else BASE_COLUMNS)})
+
+
+def open_writer(path, table_schema, schema=SCHEMA):
+    '''
+    Arguments:
+        path (str) = output file
+        table_schema (pa.Schema) = arrow schema of the events
+        schema (dict) = output settings, for the format, codec and level
+    Returns:
+        pq.ParquetWriter or pa.ipc.RecordBatchFileWriter
+    '''
+    if schema["format"] == "arrow":
+        codec = None if schema["compression"] == "none" else pa.Codec(schema["compression"], schema["compression_level"])
+        return pa.ipc.new_file(path, table_schema, options=pa.ipc.IpcWriteOptions(compression=codec))
+    return pq.ParquetWriter(path, table_schema, compression=schema["compression"],
+                            compression_level=schema["compression_level"])
+
+
+def write_tables(path, tables, schema=SCHEMA, empty=None):
+    '''
+    Arguments:
+        path (str) = output file
+        tables (iterable) = pyarrow tables to write, in order
+        schema (dict) = output settings, for the format, codec and level
+        empty (pa.Table) = what is written when no table has any row, see empty_table
+    Description:
+        Writes every table with rows as its own row group (record batches for arrow) through one
+        incremental writer. The file is always written, an input or entry range without a single
+        selected event gets a file without rows, so the task still has an output to report.
+    Returns:
+        events (int) = number of events written
+    '''
+    writer = None
+    file_schema = None
+    empty_schema = None # of the first table without rows, used if no table has any
+    events = 0
+    try:
+        for table in tables:
+            if len(table) == 0:
+                empty_schema = empty_schema or table.schema
+                continue
+            if writer is None:
+                file_schema = table.schema
+                writer = open_writer(path, file_schema, schema)
+            elif not table.schema.equals(file_schema):
+                table = table.cast(file_schema) # e.g. a jagged batch after fixed multiplicity ones
+            if schema["format"] == "arrow":
+                writer.write_table(table)
+            else:
+                writer.write_table(table, row_group_size=max(len(table), 1))
+            events += len(table)
+        if writer is None: # not a single event, the file is written without rows
+            if empty_schema is None:
+                empty_schema = (empty if empty is not None else empty_table(False, schema)).schema
+            writer = open_writer(path, empty_schema, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    return events
+
+
+def write_batches(path, batches, data=False):
+    '''
+    Arguments:
+        path (str) = output file
+        batches (iterable) = selected events of a task, one ak.Array per batch
+        data (bool) = True for real data, for the columns of a file without any event
+    Description:
+        Writes the schema's columns of every batch as its own row group
+    Returns:
+        events (int) = number of events written
+    '''
+    return write_tables(path, (to_table(batch) for batch in batches), empty=empty_table(data))
+
+
+def read_parts(parts):
+    '''
+    Arguments:
+        parts (list) = files written by write_batches for consecutive entry ranges of the same input
+    Yields:
+        pyarrow table of every row group (record batch for arrow) of the parts, in order
+    '''
+    for part in parts:
+        if not os.path.exists(part): # a range can end up without any batch
+            continue
+        if SCHEMA["format"] == "arrow":
+            with pa.memory_map(part) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield pa.Table.from_batches([reader.get_batch(i)])
+            continue
+        part_file = pq.ParquetFile(part)
+        for i in range(part_file.num_row_groups):
+            yield part_file.read_row_group(i)
+
+
+def merge_parts(path, parts, data=False):
+    '''
+    Arguments:
+        path (str) = output file
+        parts (list) = files written for consecutive entry ranges of the same input
+        data (bool) = True for real data, for the columns of a file without any event
+    Description:
+        Copies the row groups of the parts into one file, one row group in memory at a time
+    Returns:
+        events (int) = number of events written
+    '''
+    return write_tables(path, read_parts(parts), empty=empty_table(data))
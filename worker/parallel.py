@@ -0,0 +1,187 @@
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import accumulator
+import HZZAnalysis_Funcs as HZZ
+import histograms
+import http_source
+import outputs
+
+'''
+Intra-file parallelism. A file is split into entry ranges on basket cluster
+boundaries, every range is run through the selection on its own process and
+the partial results are merged before the task is acknowledged.
+'''
+
+# Ranges smaller than this are not worth a process of their own
+MIN_RANGE_ENTRIES = int(os.environ.get("HZZ_MIN_RANGE_ENTRIES", 100000))
+
+
+def cpu_quota():
+    '''
+    Description:
+        Works out how many CPUs the container may use, from the cgroup CPU quota when one
+        is set and from the CPUs the process is allowed to run on otherwise
+    Returns:
+        cpus (int)
+    '''
+    cpus = len(os.sched_getaffinity(0))
+    try: # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try: # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    return max(cpus, 1)
+
+
+def pool_size():
+    '''
+    Description:
+        Number of processes a file is split over. HZZ_PROCESSES overrides the default of
+        the container's CPU quota.
+    Returns:
+        processes (int)
+    '''
+    return int(os.environ.get("HZZ_PROCESSES", 0)) or cpu_quota()
+
+
+def make_pool(processes):
+    '''
+    Arguments:
+        processes (int) = size of the pool
+    Description:
+        Creates the process pool used to run the ranges of a file. Its processes start on the
+        first task, from a task thread while the event loop, metrics server, prefetch and HTTP
+        threads are running, so they come from a forkserver instead of a fork of this process
+        (which could copy a lock held by another thread). The forkserver imports the analysis
+        modules once, so each process starts without importing them again.
+    Returns:
+        ProcessPoolExecutor, or None when only one process would be used
+    '''
+    if processes <= 1:
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["parallel"])
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def split_entries(file_path, sample, n_ranges, entry_start=0, entry_stop=None):
+    '''
+    Arguments:
+        file_path (str) = path or url of the ROOT file
+        sample (str) = name of the sample the file belongs to
+        n_ranges (int) = maximum number of ranges to split into
+        entry_start, entry_stop (int) = entry range of the file to split (default: all of it)
+    Description:
+        Splits the entries of a file into roughly equal ranges that start and end on basket
+        cluster boundaries, so no basket has to be read by two processes
+    Returns:
+        list of (start, stop) entry ranges
+    '''
+    tree = HZZ.open_tree(file_path)
+    cheap, heavy = HZZ.plan_branches(sample)
+    entry_stop = tree.num_entries if entry_stop is None else min(entry_stop, tree.num_entries)
+    entry_start = min(entry_start, entry_stop)
+    n_ranges = max(1, min(n_ranges, (entry_stop - entry_start) // MIN_RANGE_ENTRIES))
+    clusters = HZZ.cluster_offsets(tree, cheap + heavy, entry_start, entry_stop)
+    targets = np.linspace(entry_start, entry_stop, n_ranges + 1)
+    edges = np.unique(clusters[np.abs(clusters[:, None] - targets[None, :]).argmin(axis=0)])
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist())) or [(entry_start, entry_stop)]
+
+
+def run_range(file_path, sample, entry_start, entry_stop, step_size, output_mode, out_file):
+    '''
+    Arguments:
+        file_path (str) = path or url of the ROOT file
+        sample (str) = name of the sample the file belongs to
+        entry_start, entry_stop (int) = entry range to process
+        step_size (int or str) = batch size passed to HZZ.iter_batches
+        output_mode (str) = "hist" or "events"
+        out_file (str) = where the events of this range are written in events mode
+    Description:
+        Runs the selection over one entry range. This is what runs on the pool.
+    Returns:
+        dict with the cut flow, the network use and either the partial histogram or the events
+        file of the range
+    '''
+    network = http_source.network_stats()
+    cutflow = {}
+    batches = HZZ.iter_batches(file_path, sample, cutflow, step_size, entry_start, entry_stop)
+    if output_mode == "hist":
+        hist = histograms.fill_batches(batches, HZZ.is_data(sample))
+        return {"cutflow": cutflow, "hist": hist, "network": http_source.stats_since(network)}
+    outputs.write_batches(out_file, batches, HZZ.is_data(sample))
+    return {"cutflow": cutflow, "events": out_file, "network": http_source.stats_since(network)}
+
+
+def process_file(file_path, sample, out_file, output_mode, step_size, pool=None, processes=1,
+                 entry_start=0, entry_stop=None):
+    '''
+    Arguments:
+        file_path (str) = path or url of the ROOT file
+        sample (str) = name of the sample the file belongs to
+        out_file (str) = output file of the task
+        output_mode (str) = "hist" or "events"
+        step_size (int or str) = batch size passed to HZZ.iter_batches
+        pool (ProcessPoolExecutor) = pool to run the ranges on, None runs the file serially
+        processes (int) = size of the pool
+        entry_start, entry_stop (int) = entry range of the file to process (default: all of it)
+    Description:
+        Processes a file, split over the pool when it is large enough, and writes the merged output
+    Returns:
+        cutflow (dict) = cut flow of the whole file
+        network (dict) = bytes fetched, requests made and seconds spent on the network for the file
+    '''
+    network = http_source.network_stats()
+    ranges = [(entry_start, entry_stop)]
+    if pool is not None:
+        ranges = split_entries(file_path, sample, processes, entry_start, entry_stop)
+
+    parts_dir = None
+    try:
+        if len(ranges) == 1: # nothing to merge, write straight to the output
+            results = [run_range(file_path, sample, *ranges[0], step_size, output_mode, out_file)]
+        else:
+            parts_dir = tempfile.mkdtemp(prefix="hzz-ranges-")
+            futures = [pool.submit(run_range, file_path, sample, start, stop, step_size, output_mode,
+                                   os.path.join(parts_dir, f"{i}{outputs.EXTENSION}"))
+                       for i, (start, stop) in enumerate(ranges)]
+            results = [future.result() for future in futures]
+
+        cutflow = {}
+        for result in results:
+            accumulator.merge_cutflows(cutflow, result["cutflow"])
+
+        if output_mode == "hist":
+            hist = results[0]["hist"]
+            for result in results[1:]:
+                hist.merge(result["hist"])
+            histograms.write_partial(out_file, sample, hist, cutflow)
+        elif parts_dir is not None:
+            outputs.merge_parts(out_file, [result["events"] for result in results], HZZ.is_data(sample))
+    finally:
+        if parts_dir is not None:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+    # This process's own reads (opening the file, or the whole file when run serially)
+    # plus whatever the pool processes read
+    network = http_source.stats_since(network)
+    if parts_dir is not None:
+        for result in results:
+            for key in network:
+                network[key] += result["network"][key]
+    return cutflow, network
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+import file_cache
+
+'''
+Background download of the input files of tasks the worker has reserved but
+not started yet, so the network is busy while the CPU works on the current
+file. Downloads are bounded by the look-ahead depth (number of downloads in
+flight) and by a disk budget; a file that does not fit is streamed as before.
+When the persistent input cache is enabled the files are fetched into the
+cache instead, which then owns them and applies its own budget.
+'''
+
+
+class Prefetcher:
+    def __init__(self, depth, budget, directory, cache=None):
+        '''
+        Arguments:
+            depth (int) = how many files may be downloaded ahead of the one being processed
+            budget (int) = bytes of local disk the downloaded files may use
+            directory (str) = where the downloaded files are kept
+            cache (file_cache.FileCache) = persistent input cache to fetch into instead, if any
+        '''
+        self.depth = depth
+        self.cache = cache
+        self.budget = budget
+        self.directory = directory
+        self.used = 0 # bytes reserved by downloaded or downloading files
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.downloads = ThreadPoolExecutor(max_workers=depth) if depth > 0 else None
+        self.active = {} # url -> [future, number of reserved tasks using it], shards share a download
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, url):
+        '''
+        Arguments:
+            url (str) = input file of a reserved task
+        Description:
+            Starts downloading the file in the background when it is remote and fits in the budget
+        Returns:
+            Future resolving to the path the task should read (a local copy, or url itself)
+        '''
+        if self.downloads is None or not file_cache.is_remote(url):
+            done = Future()
+            done.set_result(url)
+            return done
+        with self.lock:
+            if url in self.active: # another shard of the same file is already reserved
+                self.active[url][1] += 1
+                return self.active[url][0]
+            if self.cache is not None:
+                future = self.downloads.submit(self.cache.fetch, url)
+            else:
+                future = self.downloads.submit(self._download, url)
+            self.active[url] = [future, 1]
+        return future
+
+    def release(self, url):
+        '''
+        Arguments:
+            url (str) = input file of a finished task, as passed to fetch
+        Description:
+            Once no reserved task uses the file any more, deletes the downloaded copy and frees its
+            share of the budget
+        '''
+        with self.lock:
+            if url not in self.active:
+                return
+            self.active[url][1] -= 1
+            if self.active[url][1] > 0:
+                return
+            future, _ = self.active.pop(url)
+        try:
+            path = future.result()
+        except Exception:
+            return
+        self._free(path)
+
+    def _free(self, path):
+        with self.lock:
+            size = self.sizes.pop(path, None)
+            if size is None: # streamed, or owned by the cache
+                return
+            self.used -= size
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _download(self, url):
+        try:
+            size, _ = file_cache.remote_info(url)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"[prefetch] Could not size {url}, streaming it instead: {e}")
+            return url
+
+        path = os.path.join(self.directory, f"{hashlib.sha1(url.encode()).hexdigest()[:16]}-{os.path.basename(url)}")
+        with self.lock:
+            if self.used + size > self.budget:
+                print(f"[prefetch] {url} does not fit in the disk budget, streaming it instead")
+                return url
+            self.used += size
+            self.sizes[path] = size
+
+        try:
+            file_cache.download(url, path)
+        except (requests.RequestException, OSError) as e:
+            print(f"[prefetch] Download of {url} failed, streaming it instead: {e}")
+            self._free(path)
+            return url
+        return path
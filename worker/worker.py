@@ -1,78 +1,454 @@
+import asyncio
 import json
+import collections
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 import time
 import os
-import awkward as ak
-import numpy as np
-import vector
-import uproot
 import HZZAnalysis_Funcs as HZZ
+import fingerprint
+import manifest
+import metrics
+import outputs
+import parallel
+import prefetch
+from concurrent.futures import ThreadPoolExecutor
+from config import parse_size
 
 
-data_dir = "/data/" #Establish directory to store data
+data_dir = os.environ.get("HZZ_DATA_DIR", "/data/") #Establish directory to store data
+outputs_dir = os.path.join(data_dir, "outputs")
+os.makedirs(outputs_dir, exist_ok=True)
+
+# "events" writes every selected event to parquet (or arrow), "hist" only writes the partial
+# histogram + cut flow the aggregator needs
+output_mode = os.environ.get("HZZ_OUTPUT_MODE", "events")
+
+# A batch is held about four times over while it is processed
+# (as read, after the cuts, with the derived columns, as an arrow table)
+BATCH_MEMORY_FACTOR = 4
+
+def configured_step_size():
+    '''
+    Description:
+        Works out the batch size from the environment. HZZ_STEP_SIZE is either a number of
+        entries or a memory size like "50 MB"; otherwise the batch is sized to fit
+        HZZ_MEMORY_BUDGET (e.g. "2 GB"). Falls back to uproot's default of "100 MB".
+    Returns:
+        step_size (int or str) = entries per batch or memory size, as taken by HZZ.iter_batches
+    '''
+    step = os.environ.get("HZZ_STEP_SIZE", "").strip()
+    if step:
+        return int(step) if step.isdigit() else step
+    budget = os.environ.get("HZZ_MEMORY_BUDGET", "").strip()
+    if budget:
+        return f"{parse_size(budget) // BATCH_MEMORY_FACTOR} B"
+    return "100 MB"
+
+step_size = configured_step_size()
+
+# Files are split into entry ranges processed concurrently, one process per CPU of the container
+processes = parallel.pool_size()
+pool = parallel.make_pool(processes)
+
+# Input files of the next HZZ_PREFETCH_DEPTH reserved tasks are downloaded while the current
+# one is processed, as long as they fit in HZZ_PREFETCH_BUDGET of local disk (or straight into
+# the persistent input cache when that is enabled). Off by default: a whole file is downloaded,
+# while streaming only reads the branches the selection needs
+prefetch_depth = int(os.environ.get("HZZ_PREFETCH_DEPTH", 0))
+prefetcher = prefetch.Prefetcher(prefetch_depth,
+                                 parse_size(os.environ.get("HZZ_PREFETCH_BUDGET", "10 GB")),
+                                 os.environ.get("HZZ_PREFETCH_DIR", "/tmp/hzz-prefetch"),
+                                 HZZ.input_cache)
+# Tasks whose output on the volume was made from the same input, configuration and analysis code
+# are not processed again (HZZ_REUSE_OUTPUTS=0 reprocesses everything)
+reuse_outputs = os.environ.get("HZZ_REUSE_OUTPUTS", "1") != "0"
+
+# Up to HZZ_CONCURRENT_TASKS tasks are processed at once, each on a thread of its own, while the
+# connection (heartbeats, acks, deliveries) is served by the asyncio event loop
+concurrent_tasks = int(os.environ.get("HZZ_CONCURRENT_TASKS", 1))
+task_executor = ThreadPoolExecutor(max_workers=concurrent_tasks)
+heartbeat = int(os.environ.get("HZZ_HEARTBEAT", 60))
+
+# A failed task is retried after HZZ_RETRY_DELAY seconds, doubling with every attempt up to
+# HZZ_RETRY_MAX_DELAY, and quarantined in the dead-letter queue once it has failed
+# HZZ_MAX_ATTEMPTS times
+max_attempts = int(os.environ.get("HZZ_MAX_ATTEMPTS", 3))
+retry_delay = float(os.environ.get("HZZ_RETRY_DELAY", 10))
+retry_max_delay = float(os.environ.get("HZZ_RETRY_MAX_DELAY", 300))
+
+pending = collections.deque() # (method, task body, fetched input, batch) of reserved tasks, oldest first
+running = set() # asyncio tasks of the tasks being processed
 
 def OnMessage(channel, method, properties, body):
     '''
     Arguments:
-        channel (pika.BlockingConnection.channel) = a rabbitmq object
+        channel (pika.channel.Channel) = a rabbitmq object
         method = needed
         properties = utilised in template. will keep for safety
         body = Recieved message
     Description:
-        This funtion recieves a URL dictionary from the tasks queue and passes it into the
+        This funtion reserves the task(s) of a message from the tasks queue and starts fetching
+        their files in the background. A message holds one task, or several as {"tasks": [...]}
+        when the producer batches them. The tasks are started by schedule as soon as fewer than
+        concurrent_tasks are running. Runs on the event loop.
+    '''
+    try:
+        msg = json.loads(body)
+    except Exception: # left for process_task to report and retry
+        pending.append((method, body, None, None))
+    else:
+        if "tasks" not in msg:
+            pending.append((method, body, fetch(msg), None))
+        else:
+            # The message is acked once all of its tasks are done. If it comes back because a
+            # worker stopped partway through it, the tasks already in their run's manifest were
+            # reported back then and are not processed or reported again.
+            tasks = msg["tasks"]
+            if method.redelivered:
+                tasks = unfinished(tasks)
+            if not tasks:
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            batch = {"remaining": len(tasks)}
+            for task in tasks:
+                pending.append((method, json.dumps(task), fetch(task), batch))
+    schedule(channel)
+    metrics.reserved.set(len(pending))
+
+
+def unfinished(tasks):
+    '''
+    Arguments:
+        tasks (list) = tasks of a redelivered batch message
+    Returns:
+        the tasks that are not listed in the manifest of their run yet
+    '''
+    try:
+        finished = {}
+        for task in tasks:
+            run_id = task.get("run_id", "default")
+            if run_id not in finished:
+                finished[run_id] = manifest.finished_tasks(data_dir, run_id)
+        left = [task for task in tasks if manifest.task_key(task) not in finished[task.get("run_id", "default")]]
+    except Exception as e: # processing them again is safe, the aggregator counts every task once
+        print(f"[worker] Could not check the manifest for finished tasks: {e}")
+        return tasks
+    if len(left) < len(tasks):
+        print(f"[worker] Skipping {len(tasks) - len(left)} tasks of a redelivered batch that were already done")
+    return left
+
+
+def fetch(task):
+    try:
+        task_fingerprint = fingerprint.task_fingerprint(task, output_mode)
+        if reuse_outputs and fingerprint.lookup(output_file(task, task_fingerprint), task_fingerprint):
+            return None # nothing to download, process_task reports it as a cache hit
+        return prefetcher.fetch(task["file"])
+    except Exception: # left for process_task to report and retry
+        return None
+
+
+def schedule(channel):
+    # Starts the oldest reserved tasks while there is room
+    while pending and len(running) < concurrent_tasks:
+        running.add(asyncio.ensure_future(run_task(channel, *pending.popleft())))
+
+
+async def run_task(channel, method, body, fetched, batch):
+    '''
+    Arguments:
+        channel (pika.channel.Channel) = a rabbitmq object
+        method = delivery of the message the task came in
+        body = the task
+        fetched (Future) = local copy (or url) of the file, from the prefetcher
+        batch (dict) = tasks of the same message still to finish, None for a single task message
+    Description:
+        Processes one task on the task executor, so the event loop keeps serving the connection,
+        then reports and acks (or retries) it from the loop
+    '''
+    metrics.in_flight.inc()
+    try:
+        messages = await asyncio.get_running_loop().run_in_executor(
+            task_executor, process_task, method, body, fetched
+        )
+        for msg in messages:
+            ######## Tell aggregator "I have processed a file!!!" (and where the result is) ########
+            channel.basic_publish(
+                exchange='',
+                routing_key='aggregate v3',
+                body=json.dumps(msg)
+            )
+        finish(channel, method, body, batch)
+    except Exception as e: #If there is an error, retry the task later
+        print(f"Error processing file {body}: {e}")
+        finish(channel, method, body, batch, e)
+    finally:
+        metrics.in_flight.dec()
+        running.discard(asyncio.current_task())
+        schedule(channel)
+        metrics.reserved.set(len(pending))
+
+
+def output_file(task, task_fingerprint):
+    '''
+    Arguments:
+        task (dict) = task as sent by the producer
+        task_fingerprint (str) = fingerprint of the task
+    Returns:
+        path of the task's output on the volume. Shards of the same file need their own output,
+        and the fingerprint in the name keeps outputs made with other inputs or code apart, so
+        runs sharing the volume never overwrite each other's results.
+    '''
+    entry_start = task.get("entry_start", 0)
+    entry_stop = task.get("entry_stop")
+    shard = "" if entry_stop is None else f"_{entry_start}-{entry_stop}"
+    name = f"{task['sample']}-{os.path.basename(task['file'])}{shard}-{task_fingerprint[:16]}"
+    if output_mode == "hist":
+        return os.path.join(outputs_dir, f"{name}_hist.npz")
+    return os.path.join(outputs_dir, f"{name}_frames{outputs.EXTENSION}")
+
+
+def report(task, out_file, record, cached, network=None):
+    '''
+    Arguments:
+        task (dict) = the finished task
+        out_file (str) = its output
+        record (dict) = entries, bytes, sha256 and fingerprint of the output
+        cached (bool) = whether the output was made by an earlier run
+        network (dict) = network use of the task
+    Description:
+        Adds the output to the manifest of the task's run
+    Returns:
+        the completion message for the aggregator, saying where the result is
+    '''
+    run_id = task.get("run_id", "default")
+    entry = dict(record, output=os.path.relpath(out_file, data_dir), sample=task["sample"],
+                 file=task["file"], entry_start=task.get("entry_start", 0),
+                 entry_stop=task.get("entry_stop"), cached=cached)
+    manifest.append(data_dir, run_id, entry)
+
+    msg = dict(entry, file_done=True, run_id=run_id)
+    if network is not None:
+        msg["network"] = network
+    return msg
+
+
+def retry_queue(attempt):
+    '''
+    Arguments:
+        attempt (int) = number of times the task has failed
+    Description:
+        Failed tasks wait in a queue of their own per delay, whose messages expire back into the
+        tasks queue (a single queue would hold short delays up behind long ones)
+    Returns:
+        (name, arguments) of the queue the task waits in before its next attempt
+    '''
+    delay = min(retry_delay * 2 ** (attempt - 1), retry_max_delay)
+    return f"tasks v3 retry {delay:g}s", {
+        "x-message-ttl": int(delay * 1000),
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": "tasks v3",
+    }
+
+
+def fail(channel, body, error):
+    '''
+    Arguments:
+        channel (pika.channel.Channel) = a rabbitmq object
+        body = the task that failed
+        error (Exception) = why it failed
+    Description:
+        Publishes the task to the retry queue of its attempt, or once it has failed max_attempts
+        times to the dead-letter queue, telling the aggregator not to wait for it any more
+    '''
+    persistent = pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent)
+    try:
+        task = json.loads(body)
+    except ValueError: # not a task at all, there is nothing to retry
+        channel.basic_publish(exchange='', routing_key='tasks v3 dead', body=body, properties=persistent)
+        return
+    task["attempt"] = task.get("attempt", 0) + 1
+
+    if task["attempt"] < max_attempts:
+        queue, arguments = retry_queue(task["attempt"])
+        task["queued_at"] = time.time() + arguments["x-message-ttl"] / 1000 # when it is back in the tasks queue
+        metrics.tasks.labels("retried").inc()
+        print(f"[worker] Attempt {task['attempt']} of {task['file']} failed, retrying in "
+              f"{arguments['x-message-ttl'] / 1000:g}s")
+        channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(task), properties=persistent)
+        return
+
+    print(f"[worker] {task['file']} failed {task['attempt']} times, quarantining it")
+    metrics.tasks.labels("quarantined").inc()
+    channel.basic_publish(exchange='', routing_key='tasks v3 dead',
+                          body=json.dumps(dict(task, error=str(error))), properties=persistent)
+    channel.basic_publish(
+        exchange='',
+        routing_key='aggregate v3',
+        body=json.dumps({"task_failed": True, "run_id": task.get("run_id", "default"), "task": task,
+                         "attempts": task["attempt"], "error": str(error)})
+    )
+
+
+def finish(channel, method, body, batch, error=None):
+    '''
+    Arguments:
+        channel (pika.channel.Channel) = a rabbitmq object
+        method = delivery of the message the task came in
+        body = the task
+        batch (dict) = tasks of the message still to finish, None for a single task message
+        error (Exception) = why the task failed, None when it succeeded
+    Description:
+        Acks a single task message once the task is done. A failed task is handed to fail first,
+        which retries it later on its own, so the tasks of a batch that did succeed are not redone
+        and a broken file never comes straight back. A batch is acked once its last task is finished.
+    '''
+    if error is not None:
+        fail(channel, body, error)
+    if batch is None:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    batch["remaining"] -= 1
+    if batch["remaining"] == 0:
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def process_task(method, body, fetched):
+    '''
+    Arguments:
+        method = needed
+        body = Recieved task
+        fetched (Future) = local copy (or url) of the file, from the prefetcher
+    Description:
+        This funtion passes a URL dictionary from the tasks queue into the
         data analysis function adapted from the original notebook.
+        Tasks for a shard of a large file carry the entry_start/entry_stop of the shard.
+        Runs on the task executor, errors are left for run_task to retry.
+    Returns:
+        messages (list) = completion messages to send to the aggregator
     '''
+    full_path = body
+    start = time.perf_counter()
     try: # Reading url of file
         task = json.loads(body)
+        if "queued_at" in task:
+            metrics.queue_wait_seconds.observe(max(0.0, time.time() - task["queued_at"]))
         sample = task["sample"]
         file_path = task["file"]
+        entry_start = task.get("entry_start", 0)
+        entry_stop = task.get("entry_stop")
         full_path = os.path.join(data_dir, file_path)
+        task_fingerprint = fingerprint.task_fingerprint(task, output_mode)
+        out_file = output_file(task, task_fingerprint)
+
+        record = fingerprint.lookup(out_file, task_fingerprint) if reuse_outputs else None
+        if record is not None:
+            print(f"[worker] Output of {full_path} is up to date, skipping it")
+            metrics.tasks.labels("cached").inc()
+            return [report(task, out_file, record, cached=True)]
 
+        # waits if the file is still being downloaded (nothing was fetched when the output looked
+        # up to date on arrival but no longer is)
+        input_path = fetched.result() if fetched is not None else file_path
         print(f"[worker] Processing file: {full_path} from sample: {sample}")
-        
-        sample_data = HZZ.process_data(file_path, sample) # Perform the analysis
-        
-        out_file = os.path.join(
-            data_dir,
-            f"{sample}-{os.path.basename(file_path)}_frames.parquet"
-        )
-        ak.to_parquet(sample_data, out_file)
-        
+        fingerprint.invalidate(out_file)
+        # Perform the analysis, partial results of the ranges are merged before the ack
+        cutflow, network = parallel.process_file(input_path, sample, out_file, output_mode, step_size,
+                                                 pool, processes, entry_start, entry_stop)
+        print(f"[worker] Cut flow for {file_path}: {json.dumps(cutflow)}")
+        print(f"[worker] Network for {file_path}: {network['bytes'] / 1e6:.1f} MB in "
+              f"{network['requests']} requests, {network['seconds']:.1f}s waiting")
 
+        selected = list(cutflow.values())[-1]["events"] if cutflow else 0 # events after the last cut
+        record = fingerprint.mark(out_file, task_fingerprint, selected)
         print(f"Finished processing file: {full_path}")
-        
-        ######## Tell aggregator "I have processed a file!!!" ########
-        channel.basic_publish(
-            exchange='',
-            routing_key='aggregate v3',
-            body=json.dumps({"file_done": True})
-        )
-        channel.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e: #If there is an error, requeue the task
-        print(f"Error processing file {full_path}: {e}")
-        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        print(f"[worker] Wrote {record['bytes']:,} bytes ({selected} events) to {os.path.basename(out_file)}")
+        metrics.record_task(sample, time.perf_counter() - start, cutflow, network, record["bytes"])
+        return [report(task, out_file, record, cached=False, network=network)]
+    finally:
+        if fetched is not None:
+            prefetcher.release(json.loads(body)["file"])
+
+
+def process_in_memory(body):
+    '''
+    Arguments:
+        body = Recieved task
+    Description:
+        Runs a task for the local backend (run_local.py) through the same selection as
+        process_task in hist mode, but the partial histogram and cut flow are handed back in
+        memory instead of being written to the volume, so nothing is written or reused.
+        Errors are left to the caller, which retries the task with finish/fail.
+    Returns:
+        messages (list) = the completion message, with the task's result in it
+    '''
+    start = time.perf_counter()
+    task = json.loads(body)
+    sample = task["sample"]
+    result = parallel.run_range(task["file"], sample, task.get("entry_start", 0), task.get("entry_stop"),
+                                step_size, "hist", None)
+    print(f"[worker] Cut flow for {task['file']}: {json.dumps(result['cutflow'])}")
+    metrics.record_task(sample, time.perf_counter() - start, result["cutflow"], result["network"], 0)
+    return [{"file_done": True, "run_id": task.get("run_id", "default"), "sample": sample,
+             "file": task["file"], "entry_start": task.get("entry_start", 0),
+             "entry_stop": task.get("entry_stop"), "cached": False, "network": result["network"],
+             "result": (sample, result["hist"], result["cutflow"])}]
 
 
 
 ######## Declaring rabbitmq queues ########
-connection = pika.BlockingConnection(
-    pika.ConnectionParameters(host='rabbitmq')
-)
-channel = connection.channel()
-channel.queue_declare(queue='tasks v3', durable=True)
-channel.queue_declare(queue='aggregate v3', durable=True)
-channel.basic_qos(prefetch_count=1)
+def on_connection_open(connection):
+    connection.channel(on_open_callback=on_channel_open)
+
+def on_channel_open(channel):
+    channel.add_on_close_callback(on_channel_closed)
+    channel.queue_declare(queue='tasks v3', durable=True,
+                          callback=lambda frame: channel.queue_declare(
+                              queue='aggregate v3', durable=True,
+                              callback=lambda frame: on_queues_declared(channel)))
+
+def on_queues_declared(channel):
+    for attempt in range(1, max_attempts):
+        queue, arguments = retry_queue(attempt)
+        channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+    channel.queue_declare(queue='tasks v3 dead', durable=True)
+    # the tasks being processed + the look-ahead (a batched message counts once)
+    channel.basic_qos(prefetch_count=concurrent_tasks + prefetch_depth,
+                      callback=lambda frame: start_consuming(channel))
 
 ######## Start consuming files to process (nom nom nom) ########
-channel.basic_consume(queue='tasks v3', on_message_callback=OnMessage)
-print("Worker ready, waiting for tasks...")
+def start_consuming(channel):
+    channel.basic_consume(queue='tasks v3', on_message_callback=OnMessage)
+    print(f"Worker ready, waiting for tasks ({concurrent_tasks} at a time)...")
+
+def on_channel_closed(channel, reason):
+    print(f"Error during consuming: channel closed: {reason}")
+    if not closed.done():
+        closed.set_result(reason)
+
+def on_connection_closed(connection, reason):
+    print(f"Error during consuming: connection closed: {reason}")
+    if not closed.done():
+        closed.set_result(reason)
 
-try:
-    channel.start_consuming()
-except Exception as e:
-    print(f"Error during consuming: {e}")
-finally:
-    channel.stop_consuming()
-    connection.close()
 
+async def main():
+    global closed
+    closed = asyncio.get_running_loop().create_future()
+    connection = AsyncioConnection(
+        pika.ConnectionParameters(host='rabbitmq', heartbeat=heartbeat),
+        on_open_callback=on_connection_open,
+        on_open_error_callback=on_connection_closed,
+        on_close_callback=on_connection_closed,
+    )
+    try:
+        await closed
+    finally:
+        if not connection.is_closing and not connection.is_closed:
+            connection.close()
+    # Unacked tasks go back to the queue with the connection, exit so the container is restarted
+    raise SystemExit(1)
 
+if __name__ == "__main__":
+    metrics.start()
+    asyncio.run(main())